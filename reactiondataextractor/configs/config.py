@@ -23,9 +23,31 @@ class ExtractorConfig(Config):
     ARROW_CLASSIFIER_PATH = os.path.join(Config.ROOT_DIR, '../models/cnn_weights/torch_arrow_classifier.pt')
     # Shape of an arrow image fed to the detector model
     ARROW_IMG_SHAPE = [64, 64]
+    # Inference backend of the arrow detector - one of 'eager', 'dynamic_int8' (int8 linear layers of the classifier
+    # head only - the convolutional body stays in fp32), 'torchscript', 'compile' (torch.compile) or 'onnx'
+    # (ONNX Runtime; requires the onnxruntime package). Parity and throughput are checked in tests/test_arrows.py
+    ARROW_DETECTOR_BACKEND = 'eager'
+    # Path to the ONNX export of the arrow detector (created from ARROW_DETECTOR_PATH if missing or outdated)
+    ARROW_DETECTOR_ONNX_PATH = os.path.join(Config.ROOT_DIR,
+                                            '../models/cnn_weights/torch_arrow_detector_classifier.onnx')
+    # Maximum number of patches classified at once; candidates are split into batches of equal size
+    ARROW_DETECTOR_MAX_BATCH_SIZE = 64
     # cv2 params for arrow initialization
     ARROW_CNT_MODE = cv2.RETR_EXTERNAL
     ARROW_CNT_METHOD = cv2.CHAIN_APPROX_SIMPLE
+    # Connected components whose longer side is shorter than this (in pixels) are not considered arrow candidates
+    ARROW_PREFILTER_MIN_SIZE = 8
+    # Near-square components (ratio of longer to shorter side below the first value) are not considered arrow candidates
+    # if the fraction of their bounding box covered by pixels exceeds the second value
+    ARROW_PREFILTER_SQUARE_ASPECT_RATIO = 1.25
+    ARROW_PREFILTER_SQUARE_MAX_PIXEL_RATIO = 0.5
+    # Components with a larger fraction of their bounding box covered by pixels are not considered arrow candidates
+    ARROW_PREFILTER_MAX_PIXEL_RATIO = 0.9
+    # Whether to also run the arrow classifier on components removed by the prefilter, and warn about those classified
+    # as arrows (slow, used to check the prefilter thresholds)
+    ARROW_PREFILTER_VALIDATE = False
+    # Maximum edge separation between two nearest connected components to consider them an equilibrium arrow candidate
+    ARROW_EQ_PAIR_MAX_EDGE_DIST = 40
 
     # Path to the main object detection model
     UNIFIED_EXTR_MODEL_WT_PATH = os.path.join(Config.ROOT_DIR,
@@ -36,16 +58,39 @@ class ExtractorConfig(Config):
     UNIFIED_RECLASSIFY_DIST_THRESH_COEFF = 2
     # Threshold for object detection
     UNIFIED_PRED_THRESH = 0.25
+    # Inference settings of the object detection model (defaults match those of detectron2). Lower values trade recall
+    # (mostly of small objects) for speed, which is suitable for simple single-line schemes
+    UNIFIED_INPUT_MIN_SIZE_TEST = 800
+    UNIFIED_INPUT_MAX_SIZE_TEST = 1333
+    UNIFIED_RPN_PRE_NMS_TOPK_TEST = 1000
+    UNIFIED_RPN_POST_NMS_TOPK_TEST = 1000
+    UNIFIED_DETECTIONS_PER_IMAGE = 100
+    # Opt-in optimised CPU execution of the object detection model - int8 dynamic quantisation of linear layers in the
+    # box head and channels-last backbone weights. Detections may differ slightly from those of the fp32 model
+    UNIFIED_OPTIMISED_CPU_MODE = False
     # Threshold for filtering false positives based on intersection over area
     UNIFIED_IOA_FILTER_THRESH = 0.9
+    # IoU threshold of the class-aware non-maximum suppression merging tile and full-image detections
+    UNIFIED_MERGE_NMS_IOU_THRESH = 0.5
     # Threshold for selecting small detections from image tiles (only small boxes are chosen)
     TILER_THRESH_AREA_PERCENTILE = 20
     # Maximum dimensions of tile patches
     TILER_MAX_TILE_DIMS = (600, 800)
+    # Pixels of the detectron image darker than this value (in every channel) are treated as ink when scheduling tiles
+    TILER_INK_INTENSITY_THRESH = 200
+    # Minimum number of ink pixels outside large main detections for a tile to be processed
+    TILER_MIN_INK_PIXELS = 20
+    # Maximum number of tiles processed at once, and the memory budget (in MB) used to adapt the batch size
+    TILER_MAX_BATCH_SIZE = 8
+    TILER_MEMORY_BUDGET_MB = 4096
+    # Rough estimate of memory (in MB) needed by the detection model per megapixel of its (resized) input
+    TILER_MB_PER_MEGAPIXEL = 1000
     # Distance for classifying diagrams as part of a conditions region around the arrow
     ARROW_DIAG_MAX_DISTANCE = 80
     # Distance used to crop an image around diagrams to compute appropriate dilation parameters
     DIAG_DILATION_EXT = 50
+    # Margin around the diagram crop used when thinning locally to compute dilation parameters
+    DIAG_THINNING_MARGIN = 10
     # Maximum diagram area relative to total image area
     DIAG_MAX_AREA_FRACTION = 0.45
     # Path to the dictionary containing common chemical species' names
@@ -56,6 +101,49 @@ class ExtractorConfig(Config):
     CONDITIONS_ARROW_MAX_DIST = 75
     # Maximum allowed distance difference between a labels and the first and second-closest diagram for pair reassignment
     DIAG_LABEL_MAX_REASSIGNMENT_DISTANCE = 75
+    # Inference backend of DECIMER - one of 'saved_model' (the exported model), 'xla' (XLA-compiled encoder and
+    # decoder), 'tflite_fp16' or 'tflite_int8' (TFLite encoder with float16 or int8 weights and XLA-compiled decoder).
+    # Backends other than 'saved_model' are experimental - their speed and parity with it have not been measured yet
+    DECIMER_BACKEND = 'saved_model'
+    # Maximum number of tokens decoded per diagram by the 'xla' and 'tflite' DECIMER backends
+    DECIMER_MAX_DECODE_LENGTH = 200
+    # Token buffers of the 'xla' and 'tflite' DECIMER backends grow in steps of this length (one compilation per step)
+    DECIMER_DECODE_BUCKET_LENGTH = 32
+    # Directory storing TFLite conversions of the DECIMER encoder
+    DECIMER_TFLITE_DIR = os.path.join(Config.HOME, '.cache', 'reactiondataextractor')
+    # Whether to skip optical recognition of diagram crops unlikely to contain chemical structures. The thresholds below
+    # are not calibrated yet - skipped diagrams get no SMILES, so the skip rate should be checked against accuracy first
+    DIAG_TRIAGE_ENABLED = False
+    # Single bond length (in pixels) used by the triage when it could not be estimated for a figure
+    DIAG_TRIAGE_DEFAULT_BOND_LENGTH = 30
+    # Crops whose longer side is shorter than this (in single bond lengths) are skipped as tiny fragments
+    DIAG_TRIAGE_MIN_SIZE = 0.8
+    # Crops with a single connected component elongated above this ratio of sides are skipped as lone bond lines
+    DIAG_TRIAGE_MAX_LINE_ASPECT_RATIO = 6
+    # Crops whose fraction of 'on' pixels exceeds this value are skipped as filled blobs
+    DIAG_TRIAGE_MAX_PIXEL_RATIO = 0.5
+    # Crops whose fraction of skeleton pixels is below this value are skipped as nearly empty
+    DIAG_TRIAGE_MIN_SKELETON_RATIO = 0.005
+    # Crops with several connected components, shorter than the first value (in single bond lengths) and elongated
+    # above the second ratio of sides, are skipped as text (e.g. superatoms)
+    DIAG_TRIAGE_MAX_TEXT_SIZE = 2
+    DIAG_TRIAGE_MIN_TEXT_ASPECT_RATIO = 1.5
+    # Path to the weights (.npz) of an optional logistic regression classifier used in the triage
+    DIAG_TRIAGE_CLASSIFIER_PATH = None
+    # Crops classified as structures with a lower probability are skipped
+    DIAG_TRIAGE_CLASSIFIER_THRESH = 0.5
+    # Whether to build atom graphs (corners and their adjacency) of recognised diagrams by vectorisation. Off until the
+    # graphs are used downstream - heteroatom corners and label erasure are not available for diagrams yet
+    VECTORISE_DIAGRAMS = False
+    # Whether to cache recognised SMILES on disk, so that identical diagrams are only recognised once across runs (can
+    # also be enabled with --smiles_cache)
+    SMILES_CACHE_ENABLED = False
+    # Path to the SQLite database storing the SMILES cache
+    SMILES_CACHE_PATH = os.path.join(Config.HOME, '.cache', 'reactiondataextractor', 'smiles_cache.sqlite3')
+    # Maximum number of cached SMILES; the least recently used entries are evicted above this number
+    SMILES_CACHE_MAX_ENTRIES = 100000
+    # Time (in seconds) to wait for other processes writing to the SMILES cache
+    SMILES_CACHE_TIMEOUT = 30
 
 
 class ProcessorConfig(Config):
@@ -75,6 +163,20 @@ class SchemeConfig(Config):
     MAX_GROUP_DISTANCE = 50 # TODO: Adjust this value (maybe make a coefficient out of this)
 
 
+class ResourceConfig(Config):
+    """Config used to share CPU resources between the libraries used in extraction (torch, TensorFlow, OpenCV and
+    Tesseract), and between worker processes"""
+    # Number of extraction processes running at once on the machine (overridden by --num_workers or RDE_NUM_WORKERS,
+    # while the index of each worker is given by --worker_index or RDE_WORKER_INDEX)
+    NUM_WORKERS = 1
+    # Number of threads used by each library within a worker; if None, cores are split evenly between workers
+    NUM_THREADS = None
+    # Number of threads used to run independent operations in parallel by torch and TensorFlow
+    NUM_INTEROP_THREADS = 1
+    # Whether to pin each worker to its own set of NUM_THREADS cores (Linux only)
+    PIN_CPU_AFFINITY = False
+
+
 class GlobalRGroupCache:
     def __init__(self):
         self.r_groups = set()
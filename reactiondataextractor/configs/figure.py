@@ -1,9 +1,12 @@
+from configs.config import Config
+
+__all__ = ['GlobalFigureMixin']
+
+
 class GlobalFigureMixin:
     """If no `figure` was passed to an initializer, use the figure stored in configs
     (set at the beginning of extraction)"""
+    __slots__ = ()
+
     def __init__(self, fig):
-        if fig is None:
-            import configs.config
-            self.fig = configs.config.Config.FIGURE
-        else:
-            self.fig = fig
\ No newline at end of file
+        self.fig = Config.FIGURE if fig is None else fig
@@ -19,14 +19,7 @@ import argparse
 import logging
 import os
 
-from extractors.scheme_extractor import SchemeExtractor
-from configs.config import Config
-
-MAIN_DIR = os.getcwd()
-
-log = logging.getLogger('extract')
-file_handler = logging.FileHandler(os.path.join(Config.ROOT_DIR, 'extract.log'))
-log.addHandler(file_handler)
+from utils.resources import apply_resource_limits
 
 parser = argparse.ArgumentParser()
 
@@ -34,9 +27,25 @@ parser.add_argument('--path', type=str, required=True, help='Path to a single im
 parser.add_argument('--finegrained_search', action='store_true')
 parser.add_argument('--output_dir', type=str)
 parser.add_argument('--visualize', action='store_true')
+parser.add_argument('--smiles_cache', action='store_true',
+                    help='Cache recognised SMILES on disk and reuse them for identical diagrams in subsequent runs')
+parser.add_argument('--num_workers', type=int, help='Number of extraction processes running at once on the machine')
+parser.add_argument('--worker_index', type=int, help='Index of this extraction process among --num_workers processes')
 
 opts = parser.parse_args()
 
+# Threading is set up before any of the extraction libraries (in particular TensorFlow) are initialised
+apply_resource_limits(worker_index=opts.worker_index, num_workers=opts.num_workers)
+
+from extractors.scheme_extractor import SchemeExtractor
+from configs.config import Config
+
+MAIN_DIR = os.getcwd()
+
+log = logging.getLogger('extract')
+file_handler = logging.FileHandler(os.path.join(Config.ROOT_DIR, 'extract.log'))
+log.addHandler(file_handler)
+
 if __name__ == '__main__':
     extractor = SchemeExtractor(opts)
     extractor.extract()
@@ -9,6 +9,8 @@ email: dmw51@cam.ac.uk
 import abc
 import copy
 import logging
+import os
+import tempfile
 from itertools import product
 from typing import List, Tuple, Union
 
@@ -17,12 +19,13 @@ import numpy as np
 import torch
 from matplotlib.patches import Rectangle
 from scipy.ndimage import label
+from scipy.spatial import cKDTree
 # from tensorflow.keras.models import load_model
 from torch import load, device, nn
 from configs import ExtractorConfig, Config
 from reactiondataextractor.models.base import BaseExtractor
 from reactiondataextractor.models.exceptions import NoArrowsFoundException
-from reactiondataextractor.models.segments import FigureRoleEnum, Panel, Figure, Crop
+from reactiondataextractor.models.segments import FigureRoleEnum, Panel, Figure, Crop, ConnectedComponentTable
 from reactiondataextractor.models.reaction import SolidArrow, CurlyArrow, EquilibriumArrow, ResonanceArrow, BaseArrow
 from reactiondataextractor.processors import Isolator
 
@@ -67,6 +70,7 @@ class ArrowExtractor(BaseExtractor):
         self.arrow_detector.load_state_dict(load(ExtractorConfig.ARROW_DETECTOR_PATH, map_location=device('cpu')))
         self.arrow_detector.eval()
         self.arrow_detector.to(ExtractorConfig.DEVICE)
+        self._run_detector = self._create_detector_runner(ExtractorConfig.ARROW_DETECTOR_BACKEND)
 
         self.arrows = None
         self._class_dict = {1: SolidArrow,
@@ -78,6 +82,7 @@ class ArrowExtractor(BaseExtractor):
         self._eq_arrows = []
         self._res_arrows = []
         self._curly_arrows = []
+        self._working_raw_img = None
 
     @property
     def fig(self):
@@ -86,6 +91,17 @@ class ArrowExtractor(BaseExtractor):
     @fig.setter
     def fig(self, val):
         self._fig = val
+        self._working_raw_img = None
+
+    @property
+    def working_raw_img(self) -> np.ndarray:
+        """Raw image resized to the working resolution of `self.fig`, computed once per figure"""
+        if self._working_raw_img is None:
+            if self.fig.scaling_factor:
+                self._working_raw_img = cv2.resize(self.fig.raw_img, (self.fig.img.shape[1], self.fig.img.shape[0]))
+            else:
+                self._working_raw_img = self.fig.raw_img
+        return self._working_raw_img
 
     @property
     def extracted(self):
@@ -93,19 +109,22 @@ class ArrowExtractor(BaseExtractor):
 
     def extract(self):
         """Extracts all types of arrows.
-           All individual connected components are selected and their patches fed to the classifier.
+           Individual connected components passing a cheap prefilter are selected and their patches fed to the
+           classifier.
            Additionally, to handle equilibrium arrows, pairs of nearby connected components fulfilling certain criteria are
            also selected and checked by the classifier.
            """
-        len_ccs = len(self.fig.connected_components)
-        equilibrium_arrow_cands = []
-        for idx1 in range(len_ccs-1):
-            cc1 = self.fig.connected_components[idx1]
-            closest = min(self.fig.connected_components[idx1+1:], key=lambda cc2: cc1.center_separation(cc2))
-            if cc1.edge_separation(closest) < 40:
-                candidate = Panel.create_megapanel([cc1,closest], fig=cc1.fig)
-                equilibrium_arrow_cands.append(candidate)
-        solid_arrows, eq_arrows, res_arrows,  curly_arrows = self.detect_arrows([self.fig.connected_components, equilibrium_arrow_cands])
+        table = self.fig.cc_table
+        candidates = self.prefilter_candidates(table)
+        candidate_idx = np.flatnonzero(candidates)
+        ccs = [table.panel(idx) for idx in candidate_idx]
+        if ExtractorConfig.ARROW_PREFILTER_VALIDATE:
+            self.validate_prefilter([table.panel(idx) for idx in np.flatnonzero(~candidates)])
+        equilibrium_arrow_cands = self.pair_candidates(ccs, table.centers[candidate_idx])
+        log.info(f'Arrow candidates: {len(ccs)} out of {len(table)} connected components passed the prefilter, '
+                 f'{len(equilibrium_arrow_cands)} pairs selected; {len(ccs) + len(equilibrium_arrow_cands)} '
+                 f'patches sent to the classifier')
+        solid_arrows, eq_arrows, res_arrows,  curly_arrows = self.detect_arrows([ccs, equilibrium_arrow_cands])
 
         self._solid_arrows = solid_arrows
         self._eq_arrows = eq_arrows
@@ -117,6 +136,65 @@ class ArrowExtractor(BaseExtractor):
             raise NoArrowsFoundException
         return solid_arrows, eq_arrows, res_arrows, curly_arrows
 
+    def prefilter_candidates(self, table: ConnectedComponentTable) -> np.ndarray:
+        """Selects connected components which can possibly be arrows using their stats only. Tiny dots, near-square
+        blobs and components filling almost all of their bounding box are rejected before running the classifier. Rules
+        based on the fraction of the bounding box covered by pixels are only applied to true pixel counts
+        :param table: table of connected components
+        :type table: ConnectedComponentTable
+        :return: boolean mask over rows of `table`
+        :rtype: np.ndarray"""
+        heights = table.boxes[:, 2] - table.boxes[:, 0]
+        widths = table.boxes[:, 3] - table.boxes[:, 1]
+        longer, shorter = np.maximum(heights, widths), np.maximum(np.minimum(heights, widths), 1)
+        tiny = longer < ExtractorConfig.ARROW_PREFILTER_MIN_SIZE
+        if not table.exact_pixel_areas:
+            return ~tiny
+
+        pixel_ratios = table.pixel_areas / np.maximum(table.areas, 1)
+        blob = ((longer / shorter < ExtractorConfig.ARROW_PREFILTER_SQUARE_ASPECT_RATIO) &
+                (pixel_ratios > ExtractorConfig.ARROW_PREFILTER_SQUARE_MAX_PIXEL_RATIO))
+        filled = pixel_ratios > ExtractorConfig.ARROW_PREFILTER_MAX_PIXEL_RATIO
+        return ~(tiny | blob | filled)
+
+    def validate_prefilter(self, rejected: List[Panel]) -> int:
+        """Checks that the prefilter only removes connected components which the classifier would reject, by running
+        the classifier on the removed components. Components classified as arrows are reported in a warning
+        :param rejected: connected components removed by the prefilter
+        :type rejected: List[Panel]
+        :return: number of removed components classified as arrows
+        :rtype: int"""
+        predictions = self._detect_arrows(rejected)
+        missed = [panel for panel, cls_idx in zip(rejected, np.argmax(predictions, -1)) if cls_idx != 0]
+        if missed:
+            log.warning(f'Arrow prefilter removed {len(missed)} out of {len(rejected)} components classified as '
+                        f'arrows: {missed}')
+        return len(missed)
+
+    def pair_candidates(self, ccs: List[Panel], centers: np.ndarray) -> List[Panel]:
+        """Pairs each connected component with its nearest neighbour to create equilibrium arrow candidates.
+        Pairs are found using a KD-tree over the component centers and each pair is selected once
+        :param ccs: connected components to pair
+        :type ccs: List[Panel]
+        :param centers: (N, 2) array of centers of `ccs`
+        :type centers: np.ndarray
+        :return: panels spanning pairs of nearby connected components
+        :rtype: List[Panel]"""
+        if len(ccs) < 2:
+            return []
+        _, nearest = cKDTree(centers).query(centers, k=2)
+        own_idx = np.arange(len(ccs))
+        neighbours = np.where(nearest[:, 0] == own_idx, nearest[:, 1], nearest[:, 0])
+        pairs = sorted({(min(idx1, idx2), max(idx1, idx2))
+                        for idx1, idx2 in zip(own_idx.tolist(), neighbours.tolist())})
+
+        candidates = []
+        for idx1, idx2 in pairs:
+            cc1, cc2 = ccs[idx1], ccs[idx2]
+            if cc1.edge_separation(cc2) < ExtractorConfig.ARROW_EQ_PAIR_MAX_EDGE_DIST:
+                candidates.append(Panel.create_megapanel([cc1, cc2], fig=cc1.fig))
+        return candidates
+
     def plot_extracted(self, ax):
         label_text = {SolidArrow: 'Solid arrow',
                       EquilibriumArrow: 'Equilibrium arrow',
@@ -182,53 +260,103 @@ class ArrowExtractor(BaseExtractor):
         return self.separate_arrows(filtered_arrows)
 
     def _detect_arrows(self, panels):
-        crops = [self.preprocess_model_input(arrow) for arrow in panels]
-        crops = [np.concatenate(3*[x], axis=0) for x in crops]
-        crops = np.stack(crops, axis=0)
-        BATCH_SIZE = 32
-        batches = np.arange(BATCH_SIZE, crops.shape[0], BATCH_SIZE)
-        crops = np.split(crops, batches)
-        arrows_pred = []
-        
+        if not panels:
+            return np.zeros((0, len(self._class_dict) + 1), dtype=np.float32)
+        crops = self.preprocess_model_inputs(panels)
+        crops = np.repeat(crops, 3, axis=1)
+        num_batches = -(-len(crops) // ExtractorConfig.ARROW_DETECTOR_MAX_BATCH_SIZE)
+
         with torch.no_grad():
-            for batch in crops:
-                _, out = self.arrow_detector(torch.tensor(batch))
-                arrows_pred.append(out.numpy())
+            arrows_pred = [self._run_detector(batch) for batch in np.array_split(crops, num_batches)]
         arrows_pred = np.concatenate(arrows_pred, axis=0)
         return arrows_pred
 
+    def _create_detector_runner(self, backend: str):
+        """Prepares the arrow detector for inference using `backend` and returns a function mapping a batch of
+        preprocessed patches to class probabilities
+        :param backend: one of 'eager', 'dynamic_int8', 'torchscript', 'compile' or 'onnx'
+        :type backend: str
+        :return: function running the detector on a (N, 3, height, width) float32 array
+        :rtype: Callable[[np.ndarray], np.ndarray]"""
+        width, height = ExtractorConfig.ARROW_IMG_SHAPE
+        example = torch.zeros((1, 3, height, width))
+
+        if backend == 'onnx':
+            import onnxruntime
+
+            onnx_path = ExtractorConfig.ARROW_DETECTOR_ONNX_PATH
+            if (not os.path.exists(onnx_path) or
+                    os.path.getmtime(onnx_path) < os.path.getmtime(ExtractorConfig.ARROW_DETECTOR_PATH)):
+                # Export next to the target and move into place atomically, so that concurrent workers never load
+                # a partially written model
+                fd, tmp_path = tempfile.mkstemp(suffix='.onnx', dir=os.path.dirname(onnx_path))
+                os.close(fd)
+                try:
+                    torch.onnx.export(copy.deepcopy(self.arrow_detector).cpu(), example, tmp_path,
+                                      input_names=['patches'], output_names=['step', 'classes'],
+                                      dynamic_axes={'patches': {0: 'batch'}})
+                    os.replace(tmp_path, onnx_path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+            session = onnxruntime.InferenceSession(onnx_path, providers=['CPUExecutionProvider'])
+            return lambda batch: session.run(['classes'], {'patches': batch})[0]
+
+        if backend == 'eager':
+            model = self.arrow_detector
+        elif backend == 'dynamic_int8':
+            model = torch.ao.quantization.quantize_dynamic(copy.deepcopy(self.arrow_detector).cpu(), {nn.Linear},
+                                                           dtype=torch.qint8)
+        elif backend == 'torchscript':
+            with torch.no_grad():
+                model = torch.jit.freeze(torch.jit.trace(self.arrow_detector, example.to(ExtractorConfig.DEVICE)))
+        elif backend == 'compile':
+            model = torch.compile(self.arrow_detector)
+        else:
+            raise ValueError(f'Unknown arrow detector backend: {backend}')
+        model_device = 'cpu' if backend == 'dynamic_int8' else ExtractorConfig.DEVICE
+
+        def run(batch):
+            _, out = model(torch.from_numpy(batch).to(model_device))
+            return out.cpu().numpy()
+        return run
+
     def preprocess_model_input(self, panel: Panel) -> np.ndarray:
         """Converts a panel into image array and resizes it to the desired input shape as required by the arrow detection model.
         :param panel: panel to preprocess
         :type panel: Panel"""
+        return self.preprocess_model_inputs([panel])[0]
 
-        def min_max_rescale(img):
-            min_ = np.min(img)
-            max_ = np.max(img)
-            if min_ == max_:
-                img = np.zeros_like(img)
-            else:
-                img = (img - min_) / (max_ - min_)
-            return img
-
-        arrow_crop = self.crop_from_raw_img(panel)
-        arrow_crop = arrow_crop.resize((self.fig.raw_img.shape[1], self.fig.raw_img.shape[0]), eager_cc_init=False)
-        arrow_crop = arrow_crop.resize(ExtractorConfig.ARROW_IMG_SHAPE, eager_cc_init=False)
-        arrow_crop = np.pad(arrow_crop.img, ((2, 2), (2, 2)))
-        arrow_crop = cv2.resize(arrow_crop, ExtractorConfig.ARROW_IMG_SHAPE)
-        arrow_crop = min_max_rescale(arrow_crop)
-        arrow_crop = arrow_crop[np.newaxis, ...].astype(np.float32)
+    def preprocess_model_inputs(self, panels: List[Panel]) -> np.ndarray:
+        """Converts panels into a batch of image arrays of the shape required by the arrow detection model.
+        Each panel is isolated from the raw image inside its bounding box only, resized such that together with
+        a 2-pixel margin it fills the model input shape, and min-max rescaled.
+        :param panels: panels to preprocess
+        :type panels: List[Panel]
+        :return: (N, 1, height, width) array of model inputs
+        :rtype: np.ndarray"""
+        width, height = ExtractorConfig.ARROW_IMG_SHAPE
+        margin = 2
+        raw_img = self.working_raw_img
+        batch = np.zeros((len(panels), height, width), dtype=np.float32)
+        for idx, panel in enumerate(panels):
+            top, left = max(panel.top, 0), max(panel.left, 0)
+            bottom, right = min(panel.bottom, raw_img.shape[0]), min(panel.right, raw_img.shape[1])
+            isolated = np.isin(panel.fig.labelled_img[top:bottom, left:right], panel.tags or [])
+            patch = raw_img[top:bottom, left:right] * isolated
+            batch[idx, margin:height-margin, margin:width-margin] = cv2.resize(patch, (width - 2*margin,
+                                                                                       height - 2*margin))
 
-        return arrow_crop
+        mins = batch.min(axis=(1, 2), keepdims=True)
+        ranges = batch.max(axis=(1, 2), keepdims=True) - mins
+        batch = np.divide(batch - mins, ranges, out=np.zeros_like(batch), where=ranges > 0)
+        return batch[:, np.newaxis]
 
     def crop_from_raw_img(self, panel: Panel) -> Crop:
         """Helper function used to crop an image patch from the initial (raw) img
         :param panel: panel delineating the patch to crop
         :type panel: Panel"""
-        if self.fig.scaling_factor:
-            raw_img = cv2.resize(self.fig.raw_img, (self.fig.img.shape[1], self.fig.img.shape[0]))
-        else:
-            raw_img = self.fig.raw_img
+        raw_img = self.working_raw_img
         dummy_fig = Figure(img=raw_img, raw_img=raw_img)
         isolated_raw_arrow = Isolator(dummy_fig, panel, isolate_mask=True).process()
         raw_arrow_crop = panel.create_crop(isolated_raw_arrow)
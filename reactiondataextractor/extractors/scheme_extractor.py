@@ -17,18 +17,19 @@ import cv2
 import os
 from cv2 import dnn_superres
 
+from utils.resources import apply_resource_limits
 from utils.vectorised import estimate_single_bond
-from configs.config import Config
+from configs.config import Config, ExtractorConfig
 from extractors.arrows import ArrowExtractor
 from extractors.unified import UnifiedExtractor
 from custom_preprocessing import preprocess_for_arrows, preprocess_for_labels, preprocess_for_diagrams
-from extractors.smiles import SmilesExtractor
+from extractors.smiles import SmilesExtractor, DiagramTriage
 
 from models.base import BaseExtractor
 from reactiondataextractor.models.exceptions import NoArrowsFoundException, NoDiagramsFoundException
 from models.output import ReactionScheme, RoleProbe
 from processors import ImageReaderFromArray, ImageReader, ImageScaler, ImageNormaliser, Binariser
-from recognise import DecimerRecogniser
+from recognise import DecimerRecogniser, SmilesCache
 
 
 class SchemeExtractor(BaseExtractor):
@@ -40,6 +41,8 @@ class SchemeExtractor(BaseExtractor):
         :param opts: options from the command line
         :type opts: argparse.Namespace
         """
+        apply_resource_limits(worker_index=getattr(opts, 'worker_index', None),
+                              num_workers=getattr(opts, 'num_workers', None))
         self.opts = opts
 
 
@@ -52,6 +55,10 @@ class SchemeExtractor(BaseExtractor):
         self.arrow_extractor = ArrowExtractor(fig=None)
         self.unified_extractor = UnifiedExtractor(fig=None, arrows=[], use_tiler=self.opts.finegrained_search)
         self.recogniser = DecimerRecogniser()
+        self.smiles_cache = (SmilesCache(model_fingerprint=self.recogniser.fingerprint)
+                             if ExtractorConfig.SMILES_CACHE_ENABLED or getattr(opts, 'smiles_cache', False)
+                             else None)
+        self.diagram_triage = DiagramTriage() if ExtractorConfig.DIAG_TRIAGE_ENABLED else None
 
         self.scheme = None
 
@@ -168,7 +175,8 @@ class SchemeExtractor(BaseExtractor):
             import matplotlib.pyplot as plt
             self.plot_extracted()
         
-        smiles_extractor = SmilesExtractor(diags, self.recogniser)
+        smiles_extractor = SmilesExtractor(diags, self.recogniser, cache=self.smiles_cache,
+                                           triage=self.diagram_triage)
         smiles_extractor.extract()
         if not diags_only:
             p = RoleProbe(fig, self.arrow_extractor.arrows, diags)
@@ -1,12 +1,104 @@
 """This module contains classes and routines associated with manipulating smiles, including resolving R-groups into
 individual chemical compounds"""
-from typing import List
+import logging
+from typing import Dict, List, Optional
 
+import cv2
+import numpy as np
+
+from configs.config import ExtractorConfig
 from utils.utils import erase_elements, euclidean_distance
 from utils.vectorised import DiagramVectoriser
 
 from reactiondataextractor.models import BaseExtractor
 
+log = logging.getLogger('extract.smiles')
+
+
+class DiagramTriage:
+    """Cheap filter used to skip optical recognition of diagram crops unlikely to contain chemical structures, such as
+    superatom text, '+' signs, lone bond lines and tiny fragments.
+
+    Each crop is described by a few image features, which are compared against thresholds from `ExtractorConfig`. If
+    a classifier is provided, crops passing the thresholds are additionally scored by a logistic regression over the
+    same features. Its weights are read from an .npz file with `mean`, `std`, `weights` and `bias` arrays.
+
+    :param classifier_path: path to the classifier weights, the classifier is not used if None
+    :type classifier_path: str
+    """
+    FEATURES = ['size', 'aspect_ratio', 'pixel_ratio', 'num_ccs', 'skeleton_ratio']
+
+    def __init__(self, classifier_path: Optional[str] = ExtractorConfig.DIAG_TRIAGE_CLASSIFIER_PATH):
+        self.classifier = dict(np.load(classifier_path)) if classifier_path else None
+
+    def compute_features(self, diag: 'Diagram') -> Dict[str, float]:
+        """Computes features of the binarised crop of `diag`. The size is expressed in single bond lengths.
+
+        :param diag: diagram to describe
+        :type diag: Diagram
+        :return: mapping from feature names to their values
+        :rtype: Dict[str, float]
+        """
+        crop = diag.crop
+        img = crop.img
+        height, width = img.shape[:2]
+        area = max(height * width, 1)
+        bond_length = diag.panel.fig.single_bond_length or ExtractorConfig.DIAG_TRIAGE_DEFAULT_BOND_LENGTH
+        skeleton = cv2.ximgproc.thinning(img) if height > 1 and width > 1 else img
+        return {'size': max(height, width) / bond_length,
+                'aspect_ratio': max(height, width) / max(min(height, width), 1),
+                'pixel_ratio': np.count_nonzero(img) / area,
+                'num_ccs': len(crop.cc_table.labels),
+                'skeleton_ratio': np.count_nonzero(skeleton) / area}
+
+    def classify(self, features: Dict[str, float]) -> Optional[str]:
+        """Decides whether a crop described by `features` should be recognised
+
+        :param features: features of a diagram crop, as computed by `compute_features`
+        :type features: Dict[str, float]
+        :return: reason for skipping the crop, or None if the crop is likely a chemical structure
+        :rtype: Optional[str]
+        """
+        if features['size'] < ExtractorConfig.DIAG_TRIAGE_MIN_SIZE:
+            return 'tiny fragment'
+        if features['num_ccs'] == 1 and features['aspect_ratio'] > ExtractorConfig.DIAG_TRIAGE_MAX_LINE_ASPECT_RATIO:
+            return 'lone line'
+        if features['pixel_ratio'] > ExtractorConfig.DIAG_TRIAGE_MAX_PIXEL_RATIO:
+            return 'filled blob'
+        if features['skeleton_ratio'] < ExtractorConfig.DIAG_TRIAGE_MIN_SKELETON_RATIO:
+            return 'sparse crop'
+        if (features['num_ccs'] > 1 and features['size'] < ExtractorConfig.DIAG_TRIAGE_MAX_TEXT_SIZE and
+                features['aspect_ratio'] > ExtractorConfig.DIAG_TRIAGE_MIN_TEXT_ASPECT_RATIO):
+            return 'text'
+        if self.classifier is not None:
+            x = (np.array([features[name] for name in self.FEATURES]) - self.classifier['mean']) / self.classifier['std']
+            probability = 1 / (1 + np.exp(-(x @ self.classifier['weights'] + self.classifier['bias'])))
+            if float(probability) < ExtractorConfig.DIAG_TRIAGE_CLASSIFIER_THRESH:
+                return 'classifier'
+        return None
+
+    def triage(self, diags: List['Diagram']) -> List['Diagram']:
+        """Marks diagrams that should not be recognised by setting their `triage_reason`. Each decision is logged at
+        debug level together with the features, and the overall skip rate at info level.
+
+        :param diags: diagrams to triage
+        :type diags: List[Diagram]
+        :return: diagrams that should be recognised
+        :rtype: List[Diagram]
+        """
+        kept = []
+        for diag in diags:
+            features = self.compute_features(diag)
+            diag.triage_reason = self.classify(features)
+            decision = 'recognise' if diag.triage_reason is None else f'skip ({diag.triage_reason})'
+            log.debug(f'Triage of {diag.panel}: {decision}, features: '
+                     + ', '.join(f'{name}={value:.3g}' for name, value in features.items()))
+            if diag.triage_reason is None:
+                kept.append(diag)
+        log.info(f'Triage skipped {len(diags) - len(kept)} out of {len(diags)} diagrams')
+        return kept
+
+
 class SmilesExtractor(BaseExtractor):
     """Wrapper class. Wraps the main Optical Chemical Structure Recognition class.
     
@@ -14,31 +106,69 @@ class SmilesExtractor(BaseExtractor):
     :type diagrams: List[Diagram]
     :param recogniser: instance of the wrapped OCSR class that performs the recognition
     :type recogniser: DecimerRecogniser
+    :param cache: persistent cache of recognised SMILES, not used if None
+    :type cache: SmilesCache
+    :param triage: filter of diagrams unlikely to be chemical structures, no diagrams are skipped if None
+    :type triage: DiagramTriage
     :param vectoriser: instance of a vectorisation class"""
-    def __init__(self, diagrams: List['Diagram'], recogniser: 'DecimerRecogniser'):
+    def __init__(self, diagrams: List['Diagram'], recogniser: 'DecimerRecogniser', cache: 'SmilesCache' = None,
+                 triage: DiagramTriage = None):
         self.diagrams = diagrams
         self.recogniser = recogniser
+        self.cache = cache
+        self.triage = triage
         self.vectoriser = DiagramVectoriser()
 
     def extract(self) -> None:
         """This method is a wrapper method that call the OCSR engine"""
         print('Running OCSR engine...')
-        for diag in self.diagrams:
-            self.vectoriser.diag = diag
-            # self.vectoriser.create_vectorised_diagram_graph()
-            self.recognise(diag)
+        diagrams = self.triage.triage(self.diagrams) if self.triage is not None else self.diagrams
+        if not diagrams:
+            return
+        if ExtractorConfig.VECTORISE_DIAGRAMS:
+            self.vectoriser.create_vectorised_diagram_graphs(diagrams)
+        chemical_structures = self.recogniser.decode_images([diag.crop.img_detectron for diag in diagrams])
+        if self.cache is None:
+            for diag, chemical_structure in zip(diagrams, chemical_structures):
+                self.recognise(diag, chemical_structure)
+            return
+
+        # Identical diagrams are recognised once, and only if they have not been recognised before
+        diags_by_key = {}
+        structures_by_key = {}
+        for diag, chemical_structure in zip(diagrams, chemical_structures):
+            key = self.cache.key(chemical_structure)
+            diags_by_key.setdefault(key, []).append(diag)
+            structures_by_key.setdefault(key, chemical_structure)
+        cached = self.cache.get_many(diags_by_key.keys())
+
+        recognised = {}
+        for key, diags in diags_by_key.items():
+            if key in cached:
+                smiles = cached[key]
+            else:
+                self.recognise(diags[0], structures_by_key[key])
+                smiles = recognised[key] = diags[0].smiles
+            for diag in diags:
+                diag.smiles = smiles
+        self.cache.put_many(recognised)
+        log.info(f'Recognised {len(recognised)} out of {len(diagrams)} diagrams '
+                 f'({len(cached)} distinct diagrams found in the SMILES cache)')
 
-    def recognise(self, diag) -> None:
+    def recognise(self, diag, chemical_structure=None) -> None:
         """This is the recognition method. Image patch corresponding to the input diagram 
         is preprocessed, fed through the model, and detokenised to give SMILES representation. 
         Updates `smiles` attribute of the diagram.
         :param diag: input chemical diagram for optical recognition
         :type diag: Diagram
+        :param chemical_structure: preprocessed model input for `diag`, computed from the diagram's crop if not provided
+        :type chemical_structure: Tensor
         """
         crop = diag.crop
         lone_groups = []
 
-        chemical_structure = self.recogniser.decode_image(crop.img_detectron)
-        predicted_tokens = self.recogniser.model(chemical_structure)
+        if chemical_structure is None:
+            chemical_structure = self.recogniser.decode_images([crop.img_detectron])[0]
+        predicted_tokens = self.recogniser.predict(chemical_structure)
         predicted_SMILES = self.recogniser.detokenize_output(predicted_tokens)
         diag.smiles = predicted_SMILES
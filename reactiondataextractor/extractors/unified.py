@@ -1,9 +1,12 @@
 """This module contains all parts of the unified extractor for diagrams, labels and reaction conditions"""
+from concurrent.futures import ThreadPoolExecutor
 import copy
+from functools import lru_cache
 from itertools import product
 from math import ceil
 import numpy as np
 import json
+import logging
 import os
 import re
 from typing import List, Tuple, Union
@@ -15,6 +18,7 @@ from matplotlib.patches import Rectangle
 from detectron2 import model_zoo
 from detectron2.config import get_cfg
 from detectron2.engine import DefaultPredictor
+from detectron2.layers import batched_nms
 from detectron2.structures import Instances, Boxes
 import torch
 from torch import Tensor
@@ -22,11 +26,15 @@ from torch import Tensor
 from models.exceptions import NoDiagramsFoundException
 from reactiondataextractor.models import BaseExtractor, Candidate
 from reactiondataextractor.models.reaction import Label, Conditions, Diagram, CurlyArrow
-from reactiondataextractor.models.segments import Panel, Rect, FigureRoleEnum, Crop, PanelMethodsMixin, Figure
+from reactiondataextractor.models.segments import Panel, Rect, FigureRoleEnum, Crop, PanelMethodsMixin, Figure, \
+    PanelArray
 from reactiondataextractor.extractors import ConditionsExtractor, LabelExtractor
 from configs.config import ExtractorConfig
+from utils.resources import resolve_num_threads
 from reactiondataextractor.utils.utils import dilate_fig, erase_elements, find_relative_directional_position, \
-    compute_ioa, lies_along_arrow_normal, pixel_ratio
+    lies_along_arrow_normal, lies_along_arrow_normal_many, pixel_ratio
+
+log = logging.getLogger('unified')
 
 parent_dir = os.path.dirname(os.path.abspath(__file__))
 superatom_file = os.path.join(parent_dir, '..', 'dict', 'filter_superatoms.txt')
@@ -34,6 +42,18 @@ cfg = get_cfg()
 cfg.MODEL.DEVICE = 'cpu'
 
 
+@lru_cache(maxsize=None)
+def _load_superatom_pattern() -> 're.Pattern':
+    """Loads the superatoms used for filtering text false positives and compiles them into a single pattern.
+    Alternatives are sorted by length so that the longest superatom starting at a given position is matched first
+    :return: compiled pattern with the matched superatom as its first group
+    :rtype: re.Pattern"""
+    with open(superatom_file) as file:
+        superatoms = [token.strip() for line in file.readlines() for token in line.split(' ')]
+    superatoms = sorted(set(filter(None, superatoms)), key=len, reverse=True)
+    return re.compile('(?=(' + '|'.join(superatoms) + '))')
+
+
 class UnifiedExtractor(BaseExtractor):
     """The main object detection model. Combines an underlying detectron2 object detection model, as well
     as the individual diagram, labels and conditions extractors"""
@@ -141,28 +161,32 @@ class UnifiedExtractor(BaseExtractor):
         between diagrams and arrows
         :param diags: All extracted diagrams
         :type diags: list[Diagram]"""
-        for diag in diags:
-            for arrow in self.all_arrows:
-                if not isinstance(arrow, CurlyArrow) and lies_along_arrow_normal(arrow, diag) and diag.edge_separation(arrow.panel) < ExtractorConfig.ARROW_DIAG_MAX_DISTANCE:
-                    conditions = [c for c in arrow.children if isinstance(c, Conditions)]
-                    if len(conditions) > 0:
-                        conditions[0]._diags.append(diag)
-                        conditions[0].panel = Panel.create_megapanel([conditions[0].panel, diag.panel], diag.panel.fig)
-                    else:
-                        arrow.children.append(Conditions(diag.panel,None,None,None,diags=[diag]))
+        arrows = [arrow for arrow in self.all_arrows if not isinstance(arrow, CurlyArrow)]
+        if not diags or not arrows:
+            return
+        close = PanelArray(diags).edge_separation(PanelArray(arrows)) < ExtractorConfig.ARROW_DIAG_MAX_DISTANCE
+        along_normal = np.stack([lies_along_arrow_normal_many(arrow, diags) for arrow in arrows], axis=1)
+        for diag, diag_matches in zip(diags, close & along_normal):
+            for arrow in [arrows[idx] for idx in np.flatnonzero(diag_matches)]:
+                conditions = [c for c in arrow.children if isinstance(c, Conditions)]
+                if len(conditions) > 0:
+                    conditions[0]._diags.append(diag)
+                    conditions[0].panel = Panel.create_megapanel([conditions[0].panel, diag.panel], diag.panel.fig)
+                else:
+                    arrow.children.append(Conditions(diag.panel,None,None,None,diags=[diag]))
 
     def _clean_up_diag_label_matchings(self, diags):
         diags_multiple_labels = [d for d in diags if len(d.children) > 1]
-        if not diags_multiple_labels:
+        if not diags_multiple_labels or len(diags) < 2:
             return
 
+        diag_array = PanelArray(diags)
         for d in diags_multiple_labels:
             for label in d.children:
-                dists = sorted([(d, label.panel.edge_separation(d)) for d in diags], key=lambda x: x[1])[:2]
-                if len(dists) < 2:
-                    return
-                parent, dist_p = dists[0]
-                second_closest, dist_s = dists[1]
+                dists = PanelArray([label.panel]).edge_separation(diag_array)[0]
+                idx_p, idx_s = np.argsort(dists, kind='stable')[:2]
+                dist_p, dist_s = dists[idx_p], dists[idx_s]
+                second_closest = diags[idx_s]
                 no_children = not second_closest.children
                 similar_distance = dist_s - dist_p < ExtractorConfig.DIAG_LABEL_MAX_REASSIGNMENT_DISTANCE
                 if no_children and similar_distance:
@@ -241,17 +265,16 @@ class UnifiedExtractor(BaseExtractor):
         :type text_regions: list[Conditions|Label]
         :param possible_parents: list of possible parent regions (arrows for conditions, and diagrams for labels
         :type possible_parents: list[BaseArrow|Diagram]"""
-        orientations = []
-        for region in text_regions:
-            closest_possible_parent = min(possible_parents, key=region.panel.edge_separation)
-            orientations.append(closest_possible_parent.panel.find_relative_orientation(region.panel))
-        num_overlapping = len([orient for orient in orientations if sum(orient)== 0])
-        orientations = list(zip(*orientations))
-        
+        parents = PanelArray(possible_parents)
+        regions = PanelArray(text_regions)
+        closest_parent_indices, _ = parents.nearest(regions)
+        orientations = parents.relative_orientation(regions)[closest_parent_indices, np.arange(len(regions))]
+        num_overlapping = np.sum(~orientations.any(axis=1))
+
         # if half of labels are below their nearest possible parent, use this information to deduce the correct parent
-        below_panel = sum(orientations[2]) > 0.5 * (len(text_regions) - num_overlapping)
+        below_panel = np.sum(orientations[:, 2]) > 0.5 * (len(text_regions) - num_overlapping)
         for region in text_regions:
-            region.set_nearest_as_parent(possible_parents, below_panel=below_panel)
+            region.set_nearest_as_parent(parents, below_panel=below_panel)
 
     def _filter_text_false_positives(self, text_regions, diags):
         """Filter out false positives: parts of diagrams (usually superatom labels) falsely marked as conditions or labels, and plus signs.
@@ -260,45 +283,46 @@ class UnifiedExtractor(BaseExtractor):
         :param diags: detected diagrams
         :type diags: list[Diagram]
         """
-        with open(superatom_file) as file:
-            superatoms = [token.strip() for line in file.readlines() for token in line.split(' ')]
+        if not text_regions:
+            return []
+        superatom_pattern = _load_superatom_pattern()
+        if diags:
+            ioa = PanelArray(text_regions).ioa(PanelArray(diags))
+            overlaps_diags = np.any(ioa > ExtractorConfig.UNIFIED_IOA_FILTER_THRESH, axis=1)
+        else:
+            overlaps_diags = np.zeros(len(text_regions), dtype=bool)
 
-        regions_overlapping_diags = []
-        
-        to_keep = list(range(len(text_regions)))
-        for idx_to_remove, region in enumerate(text_regions):
+        filtered_regions = []
+        for region, overlaps_diag in zip(text_regions, overlaps_diags):
             text = region.text
             if isinstance(text, list):
                 text = ' '.join(text)
             if text is None:
+                filtered_regions.append(region)
                 continue
             plus_matched = re.search(r'\+', text)
             if plus_matched and len(text) < 4:
-                to_keep.remove(idx_to_remove)
-            elif any(compute_ioa(region.panel, diag) > ExtractorConfig.UNIFIED_IOA_FILTER_THRESH for diag in diags):
-                regions_overlapping_diags.append(region)
-
-        filtered_regions = [text_regions[idx] for idx in to_keep]
-        
-        to_keep = list(range(len(filtered_regions)))
-        for idx, region in enumerate(regions_overlapping_diags):
-            is_superatom = False
-            text = region.text
-            if isinstance(text, list):
-                text = ' '.join(text)
-            for superatom in superatoms:
-                matched = re.search(superatom, text)
-                # The text region should consist of the superatom and be short enough:
-                if matched and len(text) <= len(superatom) + 4:
-                    is_superatom = True
-                    break
-            if is_superatom:
-                to_keep.remove(idx)
-                
-        filtered_regions = [text_regions[idx] for idx in to_keep]
+                continue
+            if overlaps_diag and self._is_superatom(text, superatom_pattern):
+                continue
+            filtered_regions.append(region)
 
         return filtered_regions
 
+    @staticmethod
+    def _is_superatom(text: str, superatom_pattern: 're.Pattern') -> bool:
+        """Checks whether `text` consists of a superatom. The text region should contain the superatom and be short
+        enough (at most 4 characters longer than the superatom itself).
+        :param text: recognised text
+        :type text: str
+        :param superatom_pattern: compiled pattern returned by `_load_superatom_pattern`
+        :type superatom_pattern: re.Pattern
+        :return: True if `text` is a superatom label, False otherwise
+        :rtype: bool"""
+        # The lookahead reports the longest superatom starting at every position, including overlapping ones
+        longest_match = max((len(m.group(1)) for m in superatom_pattern.finditer(text)), default=None)
+        return longest_match is not None and len(text) <= longest_match + 4
+
     def clean_conditions(self, conditions: List['Conditions']) -> List['Conditions']:
         """Cleans poor conditions predictions which cover large image patches or cannot be associated with any arrow.
         :param conditions: postprocessed conditions regions
@@ -307,14 +331,12 @@ class UnifiedExtractor(BaseExtractor):
         # Clean patches that span way beyond the arrow along its direction -- this might not be necessary
 
         max_diag_area = np.max([d.panel.area for d in self.diagram_extractor.diags])
-        filtered_conditions = []
-        for c in conditions:
-            closest_arrow = self._find_closest(c, self.all_arrows)
-            dist = c.panel.edge_separation(closest_arrow.panel)
-            well_optimized = c.panel.area < ExtractorConfig.CONDITIONS_MAX_AREA_FRACTION * max_diag_area
-            close_to_arrow = dist < ExtractorConfig.CONDITIONS_ARROW_MAX_DIST
-            if well_optimized and close_to_arrow:
-                filtered_conditions.append(c)
+        if not conditions:
+            return []
+        _, dists = PanelArray(self.all_arrows).nearest(conditions)
+        well_optimized = PanelArray(conditions).areas < ExtractorConfig.CONDITIONS_MAX_AREA_FRACTION * max_diag_area
+        close_to_arrow = dists < ExtractorConfig.CONDITIONS_ARROW_MAX_DIST
+        filtered_conditions = [c for c, keep in zip(conditions, well_optimized & close_to_arrow) if keep]
 
         return filtered_conditions
 
@@ -334,32 +356,28 @@ class UnifiedExtractor(BaseExtractor):
         :type panels: list[Panel]
         :return: filtered, unique panels
         :rtype: list[Panel]"""
-        dists = np.array([[p1.edge_separation(p2) for p1 in panels] for p2 in panels])
-        not_yet_grouped = set(list(range(len(panels))))
-        if len(not_yet_grouped) == 1:
+        if len(panels) <= 1:
             return panels
+        panel_array = PanelArray(panels)
+        touching = panel_array.edge_separation() == 0
+        contains = panel_array.contains()
+        areas = panel_array.areas
+
+        not_yet_grouped = np.ones(len(panels), dtype=bool)
         groups = []
-        idx1 = 0
-        while idx1 <= len(panels) - 1:
-            if idx1 not in not_yet_grouped:
-                idx1 += 1
+        for idx1 in range(len(panels)):
+            if not not_yet_grouped[idx1]:
                 continue
-            group = [panels[idx1]]
-            not_yet_grouped.remove(idx1)
-            for idx2 in range(len(panels)):
-                if idx2 in not_yet_grouped and dists[idx1, idx2] == 0:
-                    group.append(panels[idx2])
-                    not_yet_grouped.remove(idx2)
-            groups.append(group)
-            idx1 += 1
+            not_yet_grouped[idx1] = False
+            members = np.flatnonzero(touching[idx1] & not_yet_grouped)
+            not_yet_grouped[members] = False
+            groups.append(np.concatenate(([idx1], members)))
 
         filtered = []
         for group in groups:
-            largest = max(group, key=lambda p: p.area)
-            filtered.append(largest)
-            for panel in group:
-                if not largest.contains(panel):
-                    filtered.append(panel)
+            largest = group[np.argmax(areas[group])]
+            filtered.append(panels[largest])
+            filtered.extend(panels[idx] for idx in group if not contains[largest, idx])
 
         return filtered
 
@@ -443,9 +461,13 @@ class UnifiedExtractor(BaseExtractor):
 
         conditions = []
         labels = []
-        for cand in candidates:
-            closest_arrow = self._find_closest(cand, self.all_arrows)
-            closest_diag = self._find_closest(cand, self.diagram_extractor.extracted)
+        if not candidates:
+            return conditions, labels
+        closest_arrow_indices, _ = PanelArray(self.all_arrows).nearest(candidates)
+        closest_diag_indices, _ = PanelArray(self.diagram_extractor.extracted).nearest(candidates)
+        for cand, arrow_idx, diag_idx in zip(candidates, closest_arrow_indices, closest_diag_indices):
+            closest_arrow = self.all_arrows[arrow_idx]
+            closest_diag = self.diagram_extractor.extracted[diag_idx]
             cand_class = self._adjust_class(cand, ({'arrow': closest_arrow, 'diag': closest_diag}))
 
             if cand_class == Conditions:
@@ -538,9 +560,8 @@ class UnifiedExtractor(BaseExtractor):
         """
         Measure the distance between 'panel' and 'other_objects' to find the object that is closest to the `panel`
         """
-        #TODO: This should be a method inside a `Panel` class (?)
-        dists = [(other_obj, obj.edge_separation(other_obj)) for other_obj in other_objects]
-        return sorted(dists, key=lambda elem: elem[1])[0][0]
+        closest_indices, _ = PanelArray(other_objects).nearest([obj])
+        return other_objects[closest_indices[0]]
 
     # def _place_panel_on_canvas(self, panel, canvas,fig,  left_top):
 
@@ -621,14 +642,9 @@ class DiagramExtractor(BaseExtractor):
         self._assign_diagram_parts(structure_panels, other_ccs)  # Assigns cc roles
         
         # simple filtering to account for potential multiple priors corresponding to the same diagram
-        duplicated = []
-        for idx_to_remove, panel1 in enumerate(structure_panels):
-            for panel2 in structure_panels:
-                if panel2.contains(panel1) and panel2 != panel1:
-                    duplicated.append(idx_to_remove)
-
-        duplicated = set(duplicated)
-        unique = [structure_panels[idx]  for idx in range(len(structure_panels)) if idx not in duplicated]
+        panel_array = PanelArray(structure_panels)
+        duplicated = np.any(panel_array.contains() & ~panel_array.equals(), axis=0)
+        unique = [panel for panel, is_duplicate in zip(structure_panels, duplicated) if not is_duplicate]
 
         return list(set(unique))
 
@@ -648,18 +664,26 @@ class DiagramExtractor(BaseExtractor):
         fig = self.fig
         dilated_structure_panels = []
         other_ccs = []
-        dilated_figs = {}
+        if not self.diag_priors:
+            return dilated_structure_panels, other_ccs
+
+        # Arrows are erased once, then the figure is dilated and labelled once per distinct number of iterations
+        erased_fig = erase_elements(fig, [a.panel for a in self._arrows], copy_fig=False)
+        distinct_iterations = sorted(set(fig.dilation_iterations[diag] for diag in self.diag_priors))
+
+        def dilate_and_label(num_iterations):
+            dilated = dilate_fig(erased_fig, num_iterations)
+            dilated.cc_index  # Labelling and indexing run inside the worker thread
+            return dilated
+
+        with ThreadPoolExecutor(max_workers=resolve_num_threads()) as executor:
+            dilated_figs = dict(zip(distinct_iterations, executor.map(dilate_and_label, distinct_iterations)))
+
         for diag in self.diag_priors:
-            num_iterations = fig.dilation_iterations[diag]
-            try:
-                dilated_temp = dilated_figs[num_iterations] # use cached
-            except KeyError:
-                dilated_temp = dilate_fig(erase_elements(fig, [a.panel for a in self._arrows], copy_fig=False),
-                                          num_iterations)
-                dilated_figs[num_iterations] = dilated_temp
+            dilated_temp = dilated_figs[fig.dilation_iterations[diag]]
 
             # try:
-            corresponding_panels_in_dilated_fig = [cc for cc in dilated_temp.connected_components if cc.contains(diag)]
+            corresponding_panels_in_dilated_fig = dilated_temp.cc_index.containing(diag)
             if len(corresponding_panels_in_dilated_fig) > 0:
                 dilated_structure_panel = min(corresponding_panels_in_dilated_fig, key=lambda panel: panel.area)
             else:
@@ -690,16 +714,15 @@ class DiagramExtractor(BaseExtractor):
         fig = self.fig
 
         for parent_panel in structure_panels:
-            for cc in fig.connected_components:
-                if parent_panel.contains(cc):  # Set the parent panel for all
-                    setattr(cc, 'parent_panel', parent_panel)
-                    if cc.role != FigureRoleEnum.DIAGRAMPRIOR:
-                        # Set role for all except backbone which had been set
-                        setattr(cc, 'role', FigureRoleEnum.DIAGRAMPART)
+            for cc in fig.cc_index.contained_in(parent_panel):  # Set the parent panel for all
+                setattr(cc, 'parent_panel', parent_panel)
+                if cc.role != FigureRoleEnum.DIAGRAMPRIOR:
+                    # Set role for all except backbone which had been set
+                    setattr(cc, 'role', FigureRoleEnum.DIAGRAMPART)
 
         for cc in cno_ccs:
             # ``cno_ccs`` are dilated - find raw ccs in ``fig``
-            fig_ccs = [fig_cc for fig_cc in fig.connected_components if cc.contains(fig_cc)]
+            fig_ccs = fig.cc_index.contained_in(cc)
 
             [setattr(fig_cc, 'role', None) for fig_cc in fig_ccs]
 
@@ -714,8 +737,9 @@ class DiagramExtractor(BaseExtractor):
         structure_panels = []
         disallowed_roles = [FigureRoleEnum.ARROW]
         for dilated_structure in dilated_structure_panels:
-            constituent_ccs = [cc for cc in self.fig.connected_components if dilated_structure.contains_any_pixel_of(cc)
-                               and cc.role not in disallowed_roles]
+            # Sharing a pixel requires overlapping bounding boxes, so only these ccs are checked pixel-wise
+            constituent_ccs = [cc for cc in self.fig.cc_index.overlapping(dilated_structure)
+                               if cc.role not in disallowed_roles and dilated_structure.contains_any_pixel_of(cc)]
             parent_structure_panel = Panel.create_megapanel(constituent_ccs, fig=self.fig)
             if self._diags_only or parent_structure_panel.area/self.fig.area < ExtractorConfig.DIAG_MAX_AREA_FRACTION:
                 structure_panels.append(parent_structure_panel)
@@ -730,15 +754,37 @@ class DiagramExtractor(BaseExtractor):
         :rtype: dict
         """
         num_iterations = {}
-        img = cv2.ximgproc.thinning(self.fig.img)
+        crop_rects = []
         for prior in self.diag_priors:
             top, left, bottom, right = prior
             horz_ext, vert_ext = prior.width // 2, prior.height // 2
             horz_ext = max(horz_ext, ExtractorConfig.DIAG_DILATION_EXT)
             vert_ext = max(vert_ext, ExtractorConfig.DIAG_DILATION_EXT)
-            crop_rect = Rect((top - vert_ext, left - horz_ext, bottom + vert_ext, right + horz_ext ))
-            p_ratio = pixel_ratio(img, crop_rect)
+            crop_rects.append(Rect((top - vert_ext, left - horz_ext, bottom + vert_ext, right + horz_ext )))
+
+        # Thin only the neighbourhoods of priors, unless together they are larger than the whole image. Each window is
+        # thinned with a margin around the crop, which approximates thinning of the whole image - the skeletons can
+        # still differ close to the window edges
+        margin = ExtractorConfig.DIAG_THINNING_MARGIN
+        img = self.fig.img
+        height, width = img.shape[:2]
+        thinned_windows = [(max(rect.top - margin, 0), max(rect.left - margin, 0),
+                            min(rect.bottom + margin, height), min(rect.right + margin, width)) for rect in crop_rects]
+        if sum((b - t) * (r - l) for t, l, b, r in thinned_windows if b > t and r > l) < height * width:
+            def local_pixel_ratio(rect, window):
+                w_top, w_left, w_bottom, w_right = window
+                if w_bottom <= w_top or w_right <= w_left:
+                    return 0
+                thinned = cv2.ximgproc.thinning(img[w_top:w_bottom, w_left:w_right])
+                local_rect = Rect((rect.top - w_top, rect.left - w_left, rect.bottom - w_top, rect.right - w_left))
+                return pixel_ratio(thinned, local_rect)
+            with ThreadPoolExecutor(max_workers=resolve_num_threads()) as executor:
+                p_ratios = list(executor.map(local_pixel_ratio, crop_rects, thinned_windows))
+        else:
+            thinned = cv2.ximgproc.thinning(img)
+            p_ratios = [pixel_ratio(thinned, rect) for rect in crop_rects]
 
+        for prior, p_ratio in zip(self.diag_priors, p_ratios):
             if p_ratio >= 0.03:
                 n_iterations = 4
             elif 0.005 < p_ratio < 0.03:
@@ -771,6 +817,11 @@ class Detectron2Adapter:
     cfg.MODEL.ANCHOR_GENERATOR.SIZES = [[8, 16], [16, 32], [32, 64], [64, 128], [256, 512]]
     cfg.MODEL.ROI_HEADS.BATCH_SIZE_PER_IMAGE = 512
     cfg.MODEL.ROI_HEADS.NUM_CLASSES = 3
+    cfg.INPUT.MIN_SIZE_TEST = ExtractorConfig.UNIFIED_INPUT_MIN_SIZE_TEST
+    cfg.INPUT.MAX_SIZE_TEST = ExtractorConfig.UNIFIED_INPUT_MAX_SIZE_TEST
+    cfg.MODEL.RPN.PRE_NMS_TOPK_TEST = ExtractorConfig.UNIFIED_RPN_PRE_NMS_TOPK_TEST
+    cfg.MODEL.RPN.POST_NMS_TOPK_TEST = ExtractorConfig.UNIFIED_RPN_POST_NMS_TOPK_TEST
+    cfg.TEST.DETECTIONS_PER_IMAGE = ExtractorConfig.UNIFIED_DETECTIONS_PER_IMAGE
 
     def __init__(self, fig: Figure, use_tiler:bool=True):
         """
@@ -782,6 +833,18 @@ class Detectron2Adapter:
         self.model = Rde2Predictor(self.cfg)
         self.fig = fig
         self.use_tiler = use_tiler
+        if ExtractorConfig.UNIFIED_OPTIMISED_CPU_MODE and self.cfg.MODEL.DEVICE == 'cpu':
+            self._optimise_for_cpu()
+
+    def _optimise_for_cpu(self) -> None:
+        """Prepares the model for faster CPU inference. Linear layers of the box head are dynamically quantised to
+        int8 and backbone weights are converted to channels-last memory format. Threading is set by the resource
+        governor (`utils.resources.apply_resource_limits`)
+        """
+        model = self.model.model
+        model.roi_heads.box_head = torch.ao.quantization.quantize_dynamic(model.roi_heads.box_head, {torch.nn.Linear},
+                                                                          dtype=torch.qint8)
+        model.backbone.to(memory_format=torch.channels_last)
 
     def detect(self) -> Tuple[np.ndarray]:
         """Detects the objects and applies postprocessing (changes the order of coordinates to match pipeline's
@@ -802,23 +865,18 @@ class Detectron2Adapter:
                     predictions = self.model([self.fig.img_detectron])[0]
                     predictions = predictions['instances']
             else:
-                tiler = ImageTiler(self.fig.img_detectron, ExtractorConfig.TILER_MAX_TILE_DIMS, main_predictions=None)
-                tiles = tiler.create_tiles()
-                BATCH_SIZE = 4
-                batches = np.arange(BATCH_SIZE, tiles.shape[0], BATCH_SIZE)
-                tiles_batches = np.split(tiles, batches)
-                predictions = []
                 with torch.no_grad():
-                    predictions.append(self.model([self.fig.img_detectron])[0])
-                    for batch in tiles_batches:
-                        predictions += self.model(batch)
-                main_predictions = predictions[0]['instances']
-                tiler.main_predictions = main_predictions
-                tile_predictions = predictions[1:]
-
-                tile_predictions = tiler.transform_tile_predictions(tile_predictions)
-                tile_predictions = tiler.filter_small_boxes(tile_predictions)
-                predictions = self.combine_predictions(main_predictions, tile_predictions)
+                    main_predictions = self.model([self.fig.img_detectron])[0]['instances']
+                tiler = ImageTiler(self.fig.img_detectron, ExtractorConfig.TILER_MAX_TILE_DIMS,
+                                   main_predictions=main_predictions)
+                tiles = tiler.create_tiles()
+                if tiles:
+                    tile_predictions = self._predict_tiles(tiles)
+                    tile_predictions = tiler.transform_tile_predictions(tile_predictions)
+                    tile_predictions = tiler.filter_small_boxes(tile_predictions)
+                    predictions = self.combine_predictions(main_predictions, tile_predictions)
+                else:
+                    predictions = main_predictions
 
             high_scores = predictions.scores.numpy() > ExtractorConfig.UNIFIED_PRED_THRESH
             pred_boxes = predictions.pred_boxes.tensor.numpy()[high_scores]
@@ -839,6 +897,38 @@ class Detectron2Adapter:
         #     plt.show()
         return pred_boxes, pred_classes,
 
+    def _predict_tiles(self, tiles: List[np.ndarray]) -> List[dict]:
+        """Runs the model on image tiles of native sizes. Tiles of similar shapes are batched together and the batch
+        size is adapted to the number of cores and the memory budget
+        :param tiles: image tiles
+        :type tiles: list[np.ndarray]
+        :return: predictions for each tile, in the order of `tiles`
+        :rtype: list[dict]"""
+        batch_size = self._tile_batch_size(tiles)
+        order = sorted(range(len(tiles)), key=lambda idx: tiles[idx].shape[:2])
+        predictions = [None] * len(tiles)
+        with torch.no_grad():
+            for start in range(0, len(order), batch_size):
+                batch_idx = order[start:start + batch_size]
+                for idx, prediction in zip(batch_idx, self.model([tiles[idx] for idx in batch_idx])):
+                    predictions[idx] = prediction
+        return predictions
+
+    def _tile_batch_size(self, tiles: List[np.ndarray]) -> int:
+        """Computes the number of tiles processed at once given the threads granted to this worker and the memory
+        budget. Memory use is estimated from the size of the largest tile after resizing by the model's test-time
+        augmentation
+        :param tiles: image tiles
+        :type tiles: list[np.ndarray]
+        :return: batch size
+        :rtype: int"""
+        h, w = max(tile.shape[0] for tile in tiles), max(tile.shape[1] for tile in tiles)
+        scale = min(self.cfg.INPUT.MIN_SIZE_TEST / min(h, w), self.cfg.INPUT.MAX_SIZE_TEST / max(h, w))
+        tile_mb = h * w * scale ** 2 / 1e6 * ExtractorConfig.TILER_MB_PER_MEGAPIXEL
+        batch_size = min(resolve_num_threads(), int(ExtractorConfig.TILER_MEMORY_BUDGET_MB // tile_mb),
+                         ExtractorConfig.TILER_MAX_BATCH_SIZE, len(tiles))
+        return max(batch_size, 1)
+
     def adjust_coord_order_detectron(self, boxes:np.ndarray) -> np.ndarray:
         """Adjusts order of coordinates to the expected format
 
@@ -861,16 +951,23 @@ class Detectron2Adapter:
         return boxes.astype(np.int32)
 
     def combine_predictions(self, *preds: 'Instances') -> 'Instances':
-        """Combines predictions from the whole image, and small object detection from tiles
+        """Combines predictions from the whole image, and small object detection from tiles.
+        Duplicates (e.g. the same object detected in overlapping tiles) are removed using class-aware non-maximum
+        suppression
         :param preds: predictions from the whole image, and from image tiles
         :type preds: Instances
         :return: combined predictions as Instances object
         :rtype: Instances"""
 
-        boxes = Boxes(Tensor(np.concatenate([p.pred_boxes.tensor.numpy() for p in preds], axis=0)))
+        boxes = Tensor(np.concatenate([p.pred_boxes.tensor.numpy() for p in preds], axis=0))
         classes = Tensor(np.concatenate([p.pred_classes.numpy() for p in preds], axis=0))
         scores = Tensor(np.concatenate([p.scores.numpy() for p in preds], axis=0))
 
+        keep, _ = torch.sort(batched_nms(boxes, scores, classes, ExtractorConfig.UNIFIED_MERGE_NMS_IOU_THRESH))
+        log.info(f'Merging detections: non-maximum suppression removed {len(scores) - len(keep)} out of '
+                 f'{len(scores)} boxes')
+        boxes, classes, scores = Boxes(boxes[keep]), classes[keep], scores[keep]
+
         instances = Instances(image_size=self.fig.img.shape[:2])
         instances.set('pred_boxes', boxes)
         instances.set('pred_classes', classes)
@@ -889,11 +986,36 @@ class ImageTiler:
         self.extension = extension
         self.tile_dims = []
 
-    def create_tiles(self) -> np.ndarray:
+    @property
+    def small_box_area_thresh(self) -> float:
+        """Area below which detections are considered small, relative to the main predictions"""
+        main_pred_boxes = self.main_predictions.pred_boxes.tensor.numpy()
+        areas = (main_pred_boxes[:, 2] - main_pred_boxes[:, 0]) * (main_pred_boxes[:, 3] - main_pred_boxes[:, 1])
+        return np.percentile(areas, ExtractorConfig.TILER_THRESH_AREA_PERCENTILE)
+
+    def _uncovered_ink_integral(self) -> np.ndarray:
+        """Computes an integral image of ink pixels which do not lie inside any large main prediction. Small objects
+        are likely to be found only where such ink is present
+        :return: integral image of shape (h+1, w+1)
+        :rtype: np.ndarray"""
+        img = self.img if self.img.ndim == 2 else self.img.min(axis=2)
+        ink = img < ExtractorConfig.TILER_INK_INTENSITY_THRESH
+        if self.main_predictions is not None and len(self.main_predictions):
+            thresh_area = self.small_box_area_thresh
+            for x0, y0, x1, y1 in self.main_predictions.pred_boxes.tensor.numpy():
+                if (x1 - x0) * (y1 - y0) >= thresh_area:
+                    ink[int(y0):int(ceil(y1)), int(x0):int(ceil(x1))] = False
+        integral = np.zeros((ink.shape[0] + 1, ink.shape[1] + 1), dtype=np.int64)
+        integral[1:, 1:] = ink.cumsum(axis=0).cumsum(axis=1)
+        return integral
+
+    def create_tiles(self) -> List[np.ndarray]:
         """Creates image tiles.
-        Splits image into segments of dims no larger than tile_dims by dividing it into NxM overlapping patches
+        Splits image into segments of dims no larger than tile_dims by dividing it into NxM overlapping patches.
+        Tiles without ink, or whose ink is entirely covered by large main predictions, are skipped.
+        Tiles keep their native size
         :return: image patches
-        :rtype: np.ndarray"""
+        :rtype: list[np.ndarray]"""
         h, w = self.img.shape[:2]
         tile_h, tile_w = self.max_tile_dims
         num_h_divisor_points = ceil(h / tile_h) + 1
@@ -903,6 +1025,7 @@ class ImageTiler:
         h_segments = zip(h_segments[:-1], h_segments[1:])
         w_segments = zip(w_segments[:-1], w_segments[1:])
         tiles_dims = product(h_segments, w_segments)
+        ink_integral = self._uncovered_ink_integral()
         tiles = []
         for dims in tiles_dims:
             # print(dims)
@@ -918,13 +1041,15 @@ class ImageTiler:
             w_start = max(w_start, 0)
             w_end = min(w_end, w)
 
+            num_ink_pixels = (ink_integral[h_end, w_end] - ink_integral[h_start, w_end]
+                              - ink_integral[h_end, w_start] + ink_integral[h_start, w_start])
+            if num_ink_pixels < ExtractorConfig.TILER_MIN_INK_PIXELS:
+                continue
+
             tile = self.img[h_start:h_end, w_start:w_end]
             self.tile_dims.append(((h_start, h_end), (w_start, w_end)))
             tiles.append(tile)
-        h_max = max(t.shape[0] for t in tiles)
-        w_max = max(t.shape[1] for t in tiles)
-        tiles = [cv2.resize(t, (w_max, h_max)) for t in tiles]
-        return np.stack(tiles, 0)
+        return tiles
 
     def filter_small_boxes(self, instances: 'Instances'):
         """Filters small predictions from image patch detections to add them to the main predictions
@@ -941,8 +1066,7 @@ class ImageTiler:
             x0, y0, x1, y1 = box
             return(x1 - x0) * (y1 - y0)
 
-        main_pred_boxes = self.main_predictions.pred_boxes.tensor.numpy()
-        thresh_area = np.percentile([area(b) for b in main_pred_boxes], ExtractorConfig.TILER_THRESH_AREA_PERCENTILE)
+        thresh_area = self.small_box_area_thresh
 
         filter_idx = [i for i in range(boxes.shape[0]) if area(boxes[i]) < thresh_area]
         boxes = Boxes(boxes[filter_idx])
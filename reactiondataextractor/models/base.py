@@ -8,7 +8,10 @@ email: dmw51@cam.ac.uk
 """
 from abc import abstractmethod
 import logging
-from typing import List
+import numpy as np
+from typing import List, Union
+
+from .segments import PanelArray
 
 log = logging.getLogger(__name__)
 
@@ -59,22 +62,26 @@ class TextRegion:
     """A class for text region objects such as labels and conditions, which ought to be assigned to their respective
     parent region - diagrams and arrows respectively"""
 
-    def set_nearest_as_parent(self, objs: List['Panel'], below_panel:bool=False):
+    def set_nearest_as_parent(self, objs: Union[List['Panel'], 'PanelArray'], below_panel:bool=False):
         """Sets nearest object from objs as the panel. if 'below_panel' is set to True, then
         the nearest object from objs below self in the image is selected
 
         :param objs: list of potential parents
-        :type objs: List[Panel]
+        :type objs: List[Panel]|PanelArray
         :param below_panel: whether only objects below self in the iamge should be considered, defaults to False
         :type below_panel: bool, optional
         """
-
+        parents = objs if isinstance(objs, PanelArray) else PanelArray(objs)
+        if len(parents) == 0:
+            return
+        candidates = np.ones(len(parents), dtype=bool)
         if below_panel:
-            orientations = [obj.panel.find_relative_orientation(self.panel) for obj in objs]
+            orientations = parents.relative_orientation([self.panel])[:, 0]
             # Select overlapping labels and those below the panel
-            objs = [objs[idx] for idx in range(len(objs)) if sum(orientations[idx]) == 0 or orientations[idx][2] == 1]
-        try:
-            parent = min(objs, key=self.panel.edge_separation)
-            parent.children.append(self)
-        except ValueError:
-            pass
+            candidates = ~orientations.any(axis=1) | orientations[:, 2]
+        candidate_indices = np.flatnonzero(candidates)
+        if candidate_indices.size == 0:
+            return
+        dists = PanelArray([self.panel]).edge_separation(parents)[0]
+        parent = parents[candidate_indices[np.argmin(dists[candidate_indices])]]
+        parent.children.append(self)
@@ -393,17 +393,8 @@ class RoleProbe:
             return react_group, prod_group
         
     def _compute_scan_direction_curly_arrow(self, curly_arrow):
-        temp_fig = Figure(np.zeros_like(self.fig.img), self.fig.img)
-        temp_fig.img[curly_arrow.panel.pixels] = 255
-        temp_fig = curly_arrow.panel.create_crop(temp_fig)
-
-        selected_px = self._select_arrow_ends(temp_fig)
-        
-        top, left = curly_arrow.panel.top, curly_arrow.panel.left
-        selected_px = [(px[0]+left, px[1]+top) for px in selected_px]
-
         pairs = []
-        for px in selected_px:
+        for px in curly_arrow.end_points:
             x, y = px
             temp_rect = Rect((y,x,y,x)) 
             closest_diag = min(self.diagrams, key=lambda diag: diag.panel.edge_separation(temp_rect))
@@ -527,20 +518,7 @@ class RoleProbe:
             return panel.center_separation(temp_rect) < prox_dist
     
     def _compute_arrow_scan_params(self, arrow):
-        min_rect = cv2.minAreaRect(arrow.contour[0])
-        box_points = cv2.boxPoints(min_rect)
-        diffs = [box_points[idx+1] - box_points[idx] for idx in range(3)] + [box_points[0] - box_points[-1]]
-        box_segment_lengths = [np.sqrt(np.sum(np.power(x,2))) for x in diffs]
-        largest_idx = np.argmax(box_segment_lengths)
-        points = box_points[largest_idx], box_points[(largest_idx+1)%4]
-        x_diff = points[1][0] - points[0][0]
-        y_diff = points[1][1] - points[0][1]
-        dir_array = np.array([x_diff, y_diff])
-        direction_arrow = dir_array / np.linalg.norm(dir_array)
-
-        direction_normal = np.asarray([-1*direction_arrow[1], direction_arrow[0]])
-
-        return direction_arrow, direction_normal
+        return arrow.direction, arrow.normal
 
     def _perform_scan(self, arrow, region_dims, start_point, direction, switch):
         # assert switch in [-1, 1]
@@ -594,42 +572,3 @@ class RoleProbe:
         diags = list(set(diags))
 
         return diags
-
-    def _select_arrow_ends(self, fig):
-        img = fig.img
-        h, w = img.shape
-        h_crop, w_crop = max(int(0.05*h),5), max(int(0.05*w),5)
-        crop_1 = img[:h_crop, :]
-        crop_2 = img[-1*h_crop:, :]
-        crop_3 = img[:, :w_crop]
-        crop_4 = img[:, -1*w_crop:]
-        crops = [crop_1, crop_2, crop_3, crop_4]
-        # padded_crops = list(map(lambda x: np.pad(x, 5, constant_values=0), crops))
-        selected_px = []
-        crops_on_px = []
-        for crop in crops:
-            y, x = np.nonzero(crop)
-            if not (x.shape[0]== 0 or y.shape[0] == 0):
-            
-                crops_on_px.append(list(zip(*(y,x))))
-            else:
-                crops_on_px.append(None)
-        if crops_on_px[1] is not None:
-            crops_on_px[1] = crops_on_px[1][::-1]
-            
-        if crops_on_px[3] is not None:
-            crops_on_px[3] = crops_on_px[3][::-1]
-        #Select on_pixels closest to each image boundary
-        selected_px = [on_px_list[0] for on_px_list in crops_on_px]
-        selected_px = [[px[1], px[0]] for px in selected_px]
-        selected_px[0] = selected_px[0] if selected_px[0] else None
-        selected_px[1] = (selected_px[1][0],  selected_px[1][1] +  (h-h_crop)) if selected_px[1] else None
-        selected_px[2] = (selected_px[2][0], selected_px[2][1]) if selected_px[2] else None
-        selected_px[3] = (selected_px[3][0]+ (w-w_crop), selected_px[3][1] ) if selected_px[3] else None
-        
-        selected_px = [p for p in selected_px if p is not None]
-        pruned_px = []
-        for px1 in selected_px:
-            if all([euclidean_distance(px1, p) > max(w,h)*0.3 for p in pruned_px]):
-                pruned_px.append(px1)
-        return pruned_px
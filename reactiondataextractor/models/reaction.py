@@ -73,6 +73,8 @@ class Diagram(BaseReactionClass, PanelMethodsMixin):
     :type corners: List[Tuple[float]]
     :param adjacency_matrix: connectivity matrix between corners found by the vectorisation algorithm
     :type adjacency_matrix: np.ndarray
+    :param triage_reason: reason for which optical recognition was skipped for the diagram, None if it was not skipped
+    :type triage_reason: str
 """
 
     @classmethod
@@ -93,6 +95,7 @@ class Diagram(BaseReactionClass, PanelMethodsMixin):
         self._corrected = False
         self.corners = []
         self.adjacency_matrix = []
+        self.triage_reason = None
         super().__init__()
 
     def __eq__(self, other) -> bool:
@@ -429,6 +432,8 @@ class BaseArrow(PanelMethodsMixin):
         self.line = line
         self.contour = contour
         self._center_px = None
+        self._end_points = None
+        self._oriented_geometry = None
         self.reference_pt = self.compute_reaction_reference_pt()
         self.initialize()
         self.children = []  # set dynamically
@@ -458,14 +463,84 @@ class BaseArrow(PanelMethodsMixin):
     #     for i in unmerged_idx:
     #         new_children.append(self.children[i])
 
+    @property
+    def end_points(self) -> List[Tuple[int]]:
+        """Arrow pixels closest to each side of the arrow's bounding box, pruned such that the selected points are
+        well separated. Computed once and cached
+        :return: (x, y) coordinates of the arrow ends in the main figure
+        :rtype: list[tuple[int, int]]"""
+        if self._end_points is None:
+            self._end_points = self._select_end_points()
+        return self._end_points
+
+    @property
+    def oriented_box(self) -> np.ndarray:
+        """(4, 2) array of (x, y) corners of the minimum area rectangle fitted to the arrow contour"""
+        return self._get_oriented_geometry()['box_points']
+
+    @property
+    def direction(self) -> np.ndarray:
+        """Unit (x, y) vector along the longer side of `self.oriented_box`"""
+        return self._get_oriented_geometry()['direction']
+
+    @property
+    def normal(self) -> np.ndarray:
+        """Unit (x, y) vector normal to `self.direction`"""
+        return self._get_oriented_geometry()['normal']
+
+    @property
+    def half_length(self) -> float:
+        """Half of the longer side of `self.oriented_box`"""
+        return self._get_oriented_geometry()['half_length']
+
+    @property
+    def probe_points(self) -> np.ndarray:
+        """(4, 2) array of (x, y) points used to decide whether objects lie along the arrow normal. The first two
+        points lie along the arrow direction (1.5 half-lengths away from the center), the last two along the normal
+        (0.5 half-length away from the center)"""
+        return self._get_oriented_geometry()['probe_points']
+
+    def _get_oriented_geometry(self) -> Dict:
+        """Computes oriented geometry of the arrow once and caches it
+        :return: dictionary with the oriented box, direction, normal, half-length and probe points of the arrow
+        :rtype: dict"""
+        if self._oriented_geometry is None:
+            box_points = cv2.boxPoints(cv2.minAreaRect(self.contour[0]))
+            diffs = np.roll(box_points, -1, axis=0) - box_points
+            segment_lengths = np.sqrt(np.sum(np.power(diffs, 2), axis=1))
+            largest_idx = np.argmax(segment_lengths)
+            direction = diffs[largest_idx] / np.linalg.norm(diffs[largest_idx])
+            normal = np.asarray([-1*direction[1], direction[0]])
+            half_length = segment_lengths[largest_idx] / 2
+
+            center = np.asarray(self.panel.center)
+            probe_points = np.stack([center + direction * half_length * 1.5, center - direction * half_length * 1.5,
+                                     center + normal * half_length * .5, center - normal * half_length * .5])
+            self._oriented_geometry = {'box_points': box_points, 'direction': direction, 'normal': normal,
+                                       'half_length': half_length, 'probe_points': probe_points}
+        return self._oriented_geometry
+
+    def local_img(self, pad_width: int = 0) -> np.ndarray:
+        """Creates an image of the arrow pixels limited to its bounding box padded by `pad_width` pixels
+        :param pad_width: width of the padding around the bounding box
+        :type pad_width: int
+        :return: image of the arrow in which pixel (`pad_width`, `pad_width`) corresponds to the top-left corner of
+        the arrow's bounding box
+        :rtype: np.ndarray"""
+        top, left, bottom, right = self.panel.coords
+        rows, cols = self.pixels
+        img = np.zeros((bottom - top + 2 * pad_width, right - left + 2 * pad_width), dtype=np.uint8)
+        img[rows - top + pad_width, cols - left + pad_width] = 255
+        return img
+
     def initialize(self) -> None:
         """Given `pixels` and `panel` attributes, this method checks if other (relevant) initialization attributes
         have been precomputed. If not, these should be computed and set accordingly."""
         if self.contour is None:
-            img = np.zeros_like(self.panel.fig.img)
-            img[self.panel.pixels] = 255
-            cnt, _ = cv2.findContours(img,
-                                      ExtractorConfig.ARROW_CNT_MODE, ExtractorConfig.ARROW_CNT_METHOD)
+            pad_width = 1
+            cnt, _ = cv2.findContours(self.local_img(pad_width),
+                                      ExtractorConfig.ARROW_CNT_MODE, ExtractorConfig.ARROW_CNT_METHOD,
+                                      offset=(self.panel.left - pad_width, self.panel.top - pad_width))
             assert len(cnt) <=2
             self.contour = cnt
 
@@ -479,9 +554,7 @@ class BaseArrow(PanelMethodsMixin):
         ''
         scaling_factor = 2
         pad_width = 10
-        img = np.zeros_like(self.panel.fig.img)
-        img[self.panel.pixels] = 255
-        crop = self.panel.create_padded_crop(Figure(img, img), pad_width).img
+        crop = self.local_img(pad_width)
         crop = cv2.resize(crop, (0, 0), fx=scaling_factor, fy=scaling_factor)
         eroded = cv2.erode(crop, np.ones((3, 3)), iterations=2)
 
@@ -493,6 +566,37 @@ class BaseArrow(PanelMethodsMixin):
         row, col = row + top, col + left        
         return col, row  # x, y
 
+    def _select_end_points(self) -> List[Tuple[int]]:
+        """Selects arrow pixels closest to each side of the bounding box. Points closer to one another than 30% of
+        the larger bounding box dimension are discarded
+        :return: (x, y) coordinates of the selected points in the main figure
+        :rtype: list[tuple[int, int]]"""
+        img = self.local_img()
+        h, w = img.shape
+        h_crop, w_crop = max(int(0.05*h),5), max(int(0.05*w),5)
+        crops = [img[:h_crop, :], img[-1*h_crop:, :], img[:, :w_crop], img[:, -1*w_crop:]]
+        crops_on_px = []
+        for crop in crops:
+            y, x = np.nonzero(crop)
+            crops_on_px.append(list(zip(y, x)) if x.shape[0] else None)
+        if crops_on_px[1] is not None:
+            crops_on_px[1] = crops_on_px[1][::-1]
+        if crops_on_px[3] is not None:
+            crops_on_px[3] = crops_on_px[3][::-1]
+
+        # Select on_pixels closest to each image boundary
+        selected_px = [[on_px_list[0][1], on_px_list[0][0]] if on_px_list else None for on_px_list in crops_on_px]
+        selected_px[1] = (selected_px[1][0], selected_px[1][1] + (h-h_crop)) if selected_px[1] else None
+        selected_px[3] = (selected_px[3][0] + (w-w_crop), selected_px[3][1]) if selected_px[3] else None
+        selected_px = [p for p in selected_px if p is not None]
+
+        pruned_px = []
+        for px1 in selected_px:
+            if all([np.hypot(px1[0] - p[0], px1[1] - p[1]) > max(w,h)*0.3 for p in pruned_px]):
+                pruned_px.append(px1)
+        top, left = self.panel.top, self.panel.left
+        return [(px[0]+left, px[1]+top) for px in pruned_px]
+
 
 class SolidArrow(BaseArrow):
     """
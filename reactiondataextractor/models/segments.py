@@ -20,6 +20,7 @@ from __future__ import division
 
 from collections import Sequence
 from collections.abc import Collection
+import copy
 import numpy as np
 from enum import Enum
 from functools import wraps
@@ -139,6 +140,7 @@ class Rect(object):
     A rectangular region.
     Base class for all panels.
     """
+    __slots__ = ('top', 'left', 'bottom', 'right')
 
     @classmethod
     def create_megarect(cls, boxes: List['Rect']):
@@ -160,40 +162,14 @@ class Rect(object):
         """
         :param (int, int, int, int): (top, left, bottom, right) coordinates of top-left and bottom-right rectangle points
         """
-        self.coords = list(coords)
-
-
-    @property
-    def top(self):
-        return self.coords[0]
-
-    @top.setter
-    def top(self, value):
-        self.coords[0] = value
-
-    @property
-    def left(self):
-        return self.coords[1]
-
-    @left.setter
-    def left(self, value):
-        self.coords[1] = value
+        self.top, self.left, self.bottom, self.right = coords
 
     @property
-    def bottom(self):
-        return self.coords[2]
-
-    @bottom.setter
-    def bottom(self, value):
-        self.coords[2] = value
-
-    @property
-    def right(self):
-        return self.coords[3]
-
-    @right.setter
-    def right(self, value):
-        self.coords[3] = value
+    def coords(self):
+        """(top, left, bottom, right) coordinates of the rectangle
+        :rtype: tuple(int, int, int, int)
+        """
+        return self.top, self.left, self.bottom, self.right
 
     @property
     def width(self):
@@ -274,7 +250,7 @@ class Rect(object):
         return self.top, self.left, self.bottom, self.right
 
     def __iter__(self):
-        return iter([self.top, self.left, self.bottom, self.right])
+        return iter((self.top, self.left, self.bottom, self.right))
 
     def __hash__(self):
         return hash((self.top, self.left, self.bottom, self.right))
@@ -474,6 +450,7 @@ class Rect(object):
 
 
 class Panel(Rect, figure.GlobalFigureMixin):
+    __slots__ = ('fig', 'tags', 'role', 'parent_panel', '_crop', '_pixel_ratio', '_pixels')
 
     @classmethod
     def create_megapanel(cls, boxes: List['Panel'], fig: 'Figure') -> 'Panel':
@@ -516,8 +493,7 @@ class Panel(Rect, figure.GlobalFigureMixin):
         self.parent_panel = None
         self._crop = None
         self._pixel_ratio = None
-        self._pixels = []
-        self._zipped_pixels = []
+        self._pixels = None
 
     @property
     def pixel_ratio(self):
@@ -535,15 +511,14 @@ class Panel(Rect, figure.GlobalFigureMixin):
 
     @property
     def pixels(self):
-        """All pixels belonging to `self` in `self.fig.img`"""
-        if not self._pixels:
-            x, y = [], []
-            for tag in self.tags:
-                y_tag, x_tag = np.where(self.fig.labelled_img == tag)
-                x.extend(x_tag)
-                y.extend(y_tag)
-            self._pixels = y, x
-            self._zipped_pixels = set(zip(*self._pixels))
+        """All pixels belonging to `self` in `self.fig.img` as a (rows, cols) pair of arrays"""
+        if self._pixels is None:
+            tag_pixels = [self.fig.label_pixels(tag) for tag in self.tags]
+            if tag_pixels:
+                rows, cols = zip(*tag_pixels)
+                self._pixels = np.concatenate(rows), np.concatenate(cols)
+            else:
+                self._pixels = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
         return self._pixels
     
     def mask_off(self, fig: 'Figure') -> None:
@@ -559,7 +534,7 @@ class Panel(Rect, figure.GlobalFigureMixin):
         :return: Panel; super-panel made from all connected components that constitute the large panel in raw figure
         :rtype: Panel
         """
-        ccs_to_merge = [cc for cc in fig.connected_components if self.contains(cc)]
+        ccs_to_merge = fig.cc_index.contained_in(self)
         return Rect.create_megarect(ccs_to_merge)
 
     def in_original_fig(self, as_str: bool=True) -> Union[Tuple, str]:
@@ -571,7 +546,7 @@ class Panel(Rect, figure.GlobalFigureMixin):
         if self.fig._scaling_factor:
             ret = list(np.rint(np.asarray(self.coords) / self.fig.scaling_factor).astype(np.int32))
         else:
-            ret = self.coords
+            ret = list(self.coords)
         if as_str:
             ret = list(map(str, ret))
         return ret
@@ -585,13 +560,386 @@ class Panel(Rect, figure.GlobalFigureMixin):
         :return: True if any pixels are within both `self` and `other_panel`
         :rtype: Panel
         """
-        if self.pixels:
-            zipped_pixels = self._zipped_pixels
-        if other_panel.pixels:
-            other_zipped_pixels = other_panel._zipped_pixels
-        if len(zipped_pixels.intersection(other_zipped_pixels)) > 0:
-            return True
-        return False
+        rows, cols = self.pixels
+        other_rows, other_cols = other_panel.pixels
+        if not len(rows) or not len(other_rows):
+            return False
+        # Compare boolean masks inside the region shared by the two pixel sets
+        top, bottom = max(rows.min(), other_rows.min()), min(rows.max(), other_rows.max()) + 1
+        left, right = max(cols.min(), other_cols.min()), min(cols.max(), other_cols.max()) + 1
+        if top >= bottom or left >= right:
+            return False
+        window = (top, left, bottom, right)
+        return bool(np.any(_pixel_mask(rows, cols, window) & _pixel_mask(other_rows, other_cols, window)))
+
+
+def _pixel_mask(rows: np.ndarray, cols: np.ndarray, window: Tuple[int]) -> np.ndarray:
+    """Creates a boolean mask of (`rows`, `cols`) pixels inside a (top, left, bottom, right) `window`"""
+    top, left, bottom, right = window
+    mask = np.zeros((bottom - top, right - left), dtype=bool)
+    inside = (rows >= top) & (rows < bottom) & (cols >= left) & (cols < right)
+    mask[rows[inside] - top, cols[inside] - left] = True
+    return mask
+
+
+class PanelArray:
+    """A collection of boxes backed by an (N, 4) array of (top, left, bottom, right) coordinates. Provides vectorised
+    pairwise geometry between two collections, which replaces Python loops over `Rect` methods in postprocessing.
+    All pairwise methods return arrays indexed as [idx_self, idx_other]
+
+    :param objs: panels, or objects with a `panel` attribute (diagrams, arrows, text regions)
+    :type objs: Sequence[Panel|Diagram|BaseArrow|TextRegion]
+    """
+
+    def __init__(self, objs: Sequence):
+        self.objs = list(objs)
+        coords = [tuple(obj.panel if hasattr(obj, 'panel') else obj) for obj in self.objs]
+        self.coords = np.asarray(coords, dtype=np.float64).reshape(-1, 4)
+
+    @classmethod
+    def from_points(cls, points: Sequence[Tuple[float]]) -> 'PanelArray':
+        """Creates an array of degenerate boxes from (x, y) points, consistent with `Rect.edge_separation`"""
+        return cls([Rect((y, x, y, x)) for x, y in points])
+
+    def __len__(self):
+        return len(self.objs)
+
+    def __getitem__(self, idx):
+        return self.objs[idx]
+
+    def __iter__(self):
+        return iter(self.objs)
+
+    def take(self, indices: Sequence[int]) -> 'PanelArray':
+        """Returns a new array containing only the boxes at `indices`"""
+        subset = PanelArray([])
+        subset.objs = [self.objs[idx] for idx in indices]
+        subset.coords = self.coords[np.asarray(indices, dtype=np.int64)]
+        return subset
+
+    @property
+    def top(self):
+        return self.coords[:, 0]
+
+    @property
+    def left(self):
+        return self.coords[:, 1]
+
+    @property
+    def bottom(self):
+        return self.coords[:, 2]
+
+    @property
+    def right(self):
+        return self.coords[:, 3]
+
+    @property
+    def areas(self):
+        return (self.bottom - self.top) * (self.right - self.left)
+
+    @property
+    def centers(self):
+        """(x, y) centers of all boxes as an (N, 2) array"""
+        return np.stack([(self.left + self.right) / 2, (self.top + self.bottom) / 2], axis=1)
+
+    def _pairwise_coords(self, other: 'PanelArray'):
+        """Broadcasts coordinates of `self` along rows and coordinates of `other` along columns"""
+        other = self._as_panel_array(other)
+        t1, l1, b1, r1 = [self.coords[:, [i]] for i in range(4)]
+        t2, l2, b2, r2 = [other.coords[:, i] for i in range(4)]
+        return (t1, l1, b1, r1), (t2, l2, b2, r2)
+
+    @staticmethod
+    def _as_panel_array(other):
+        if other is None or isinstance(other, PanelArray):
+            return other
+        if isinstance(other, Rect) or hasattr(other, 'panel'):
+            return PanelArray([other])
+        return PanelArray(other)
+
+    def edge_separation(self, other: 'PanelArray' = None) -> np.ndarray:
+        """Pairwise distance between the closest edges or corners of boxes. Mirrors `Rect._edge_separation_rect`
+        exactly (including its choice of corners), so the results can be used interchangeably with the scalar version
+        :param other: other boxes; if None, distances within `self` are computed
+        :type other: PanelArray|Sequence[Panel]
+        :return: array of shape (len(self), len(other))
+        :rtype: np.ndarray"""
+        other = self if other is None else other
+        (t1, l1, b1, r1), (t2, l2, b2, r2) = self._pairwise_coords(other)
+        left = r2 < l1
+        right = r1 < l2
+        bottom = b1 < t2
+        top = b2 < t1
+        conditions = [top & left, bottom & left, bottom & right, right & top, left, right, bottom, top]
+        choices = [np.hypot(r2 - l1, b2 - t1), np.hypot(r2 - l1, t2 - t1), np.hypot(l2 - r1, t2 - t1),
+                   np.hypot(l2 - r1, b2 - b1), l1 - r2, l2 - r1, t2 - b1, t1 - b2]
+        return np.select(conditions, np.broadcast_arrays(*choices), default=0.)
+
+    def intersection_areas(self, other: 'PanelArray' = None) -> np.ndarray:
+        """Pairwise areas of intersection between boxes"""
+        other = self if other is None else other
+        (t1, l1, b1, r1), (t2, l2, b2, r2) = self._pairwise_coords(other)
+        heights = np.clip(np.minimum(b1, b2) - np.maximum(t1, t2), 0, None)
+        widths = np.clip(np.minimum(r1, r2) - np.maximum(l1, l2), 0, None)
+        return heights * widths
+
+    def ioa(self, other: 'PanelArray' = None) -> np.ndarray:
+        """Pairwise intersection over area, where the area of boxes in `self` is used (see `utils.compute_ioa`)"""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.intersection_areas(other) / self.areas[:, np.newaxis]
+
+    def iou(self, other: 'PanelArray' = None) -> np.ndarray:
+        """Pairwise intersection over union"""
+        other = self if other is None else self._as_panel_array(other)
+        intersection = self.intersection_areas(other)
+        union = self.areas[:, np.newaxis] + other.areas[np.newaxis, :] - intersection
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return intersection / union
+
+    def contains(self, other: 'PanelArray' = None) -> np.ndarray:
+        """Pairwise containment; element [i, j] is True if box j from `other` is within box i from `self`"""
+        other = self if other is None else other
+        (t1, l1, b1, r1), (t2, l2, b2, r2) = self._pairwise_coords(other)
+        return (l2 >= l1) & (r2 <= r1) & (t2 >= t1) & (b2 <= b1)
+
+    def equals(self, other: 'PanelArray' = None) -> np.ndarray:
+        """Pairwise equality of box coordinates"""
+        other = self if other is None else self._as_panel_array(other)
+        return np.all(self.coords[:, np.newaxis, :] == other.coords[np.newaxis, :, :], axis=-1)
+
+    def relative_orientation(self, other: 'PanelArray' = None) -> np.ndarray:
+        """Pairwise relative orientation of boxes in `self` with respect to boxes in `other`
+        (see `Rect.find_relative_orientation`)
+        :return: boolean array of shape (len(self), len(other), 4) with (top, left, bottom, right) flags
+        :rtype: np.ndarray"""
+        other = self if other is None else other
+        (t1, l1, b1, r1), (t2, l2, b2, r2) = self._pairwise_coords(other)
+        return np.stack(np.broadcast_arrays(b2 < t1, r2 < l1, b1 < t2, r1 < l2), axis=-1)
+
+    def nearest(self, other: 'PanelArray') -> Tuple[np.ndarray]:
+        """Finds the nearest box in `self` for every box in `other` in terms of edge separation. Ties are resolved
+        in favour of the earliest box, as in `min`
+        :param other: query boxes
+        :type other: PanelArray|Sequence[Panel]
+        :return: indices of the nearest boxes in `self` and the corresponding distances
+        :rtype: tuple[np.ndarray]"""
+        dists = self._as_panel_array(other).edge_separation(self)
+        indices = np.argmin(dists, axis=1)
+        return indices, dists[np.arange(dists.shape[0]), indices]
+
+
+class ConnectedComponentTable:
+    """Columnar table of connected components in a figure. Labels, bounding boxes, pixel areas and centroids of all
+    components are held as arrays, which allows vectorised queries over the components. A `Panel` is created for
+    a component only when it is requested.
+
+    :param fig: figure containing the components
+    :type fig: Figure
+    :param labels: labels of the components in `fig.labelled_img`
+    :type labels: np.ndarray
+    :param boxes: (N, 4) array of (top, left, bottom, right) bounding box coordinates
+    :type boxes: np.ndarray
+    :param pixel_areas: number of pixels in each component
+    :type pixel_areas: np.ndarray
+    :param centroids: (N, 2) array of (x, y) centroids of the components, as returned by OpenCV
+    :type centroids: np.ndarray
+    :param panels: already existing panels corresponding to the rows of the table
+    :type panels: Sequence[Panel]
+    :param exact_pixel_areas: whether `pixel_areas` are true pixel counts of the components inside `boxes`, rather than
+    approximations (box areas) or counts over whole components whose boxes were clipped
+    :type exact_pixel_areas: bool
+    """
+
+    def __init__(self, fig: 'Figure', labels: np.ndarray, boxes: np.ndarray, pixel_areas: np.ndarray,
+                 centroids: np.ndarray, panels: Sequence['Panel'] = None, exact_pixel_areas: bool = True):
+        self.fig = fig
+        self.exact_pixel_areas = exact_pixel_areas
+        self.labels = np.asarray(labels, dtype=np.int64)
+        self.boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+        self.pixel_areas = np.asarray(pixel_areas, dtype=np.int64)
+        self.centroids = np.asarray(centroids, dtype=np.float64).reshape(-1, 2)
+        self._panels = list(panels) if panels is not None else [None] * len(self.labels)
+
+    @classmethod
+    def from_stats(cls, fig: 'Figure', stats: np.ndarray, centroids: np.ndarray) -> 'ConnectedComponentTable':
+        """Creates a table from the output of `cv2.connectedComponentsWithStats`
+        :param fig: labelled figure
+        :type fig: Figure
+        :param stats: (N, 5) array of (x, y, width, height, area) stats of the components
+        :type stats: np.ndarray
+        :param centroids: (N, 2) array of centroids of the components
+        :type centroids: np.ndarray
+        :return: table of components
+        :rtype: ConnectedComponentTable
+        """
+        x1, y1, w, h, pixel_areas = stats.T
+        keep = w * h < fig.area * 0.95  # Spurious cc encompassing the whole image is sometimes produced
+        boxes = np.stack([y1, x1, y1 + h, x1 + w], axis=1)
+        return cls(fig, np.flatnonzero(keep), boxes[keep], pixel_areas[keep], centroids[keep])
+
+    @classmethod
+    def from_panels(cls, fig: 'Figure', panels: Sequence['Panel']) -> 'ConnectedComponentTable':
+        """Creates a table from existing panels. Pixel areas and centroids are approximated by box areas and centers
+        :param fig: figure containing the panels
+        :type fig: Figure
+        :param panels: panels to tabulate
+        :type panels: Sequence[Panel]
+        :return: table of the panels
+        :rtype: ConnectedComponentTable
+        """
+        panels = list(panels)
+        labels = [panel.tags[0] if panel.tags else -1 for panel in panels]
+        table = cls(fig, labels, [panel.coords for panel in panels], np.zeros(len(panels)),
+                    np.zeros((len(panels), 2)), panels=panels, exact_pixel_areas=False)
+        table.pixel_areas = table.areas
+        table.centroids = table.centers
+        return table
+
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def areas(self) -> np.ndarray:
+        """Areas of the bounding boxes, consistent with `Panel.area`"""
+        return (self.boxes[:, 2] - self.boxes[:, 0]) * (self.boxes[:, 3] - self.boxes[:, 1])
+
+    @property
+    def centers(self) -> np.ndarray:
+        """(N, 2) array of (x, y) centers of the bounding boxes, consistent with `Panel.center`"""
+        return np.stack([(self.boxes[:, 1] + self.boxes[:, 3]) / 2, (self.boxes[:, 0] + self.boxes[:, 2]) / 2], axis=1)
+
+    @property
+    def roles(self) -> np.ndarray:
+        """Object array of roles of the components. Components without a panel have not been assigned any role"""
+        roles = np.empty(len(self), dtype=object)
+        roles[:] = [panel.role if panel is not None else None for panel in self._panels]
+        return roles
+
+    @property
+    def panels(self) -> List['Panel']:
+        """Panels of all components in the table"""
+        return [self.panel(idx) for idx in range(len(self))]
+
+    def panel(self, idx: int) -> 'Panel':
+        """Returns the panel of the `idx`-th component, creating it on first access
+        :param idx: row of the table
+        :type idx: int
+        :return: panel of the component
+        :rtype: Panel
+        """
+        panel = self._panels[idx]
+        if panel is None:
+            panel = Panel(tuple(self.boxes[idx].tolist()), fig=self.fig, tags=[int(self.labels[idx])])
+            self._panels[idx] = panel
+        return panel
+
+
+class ConnectedComponentIndex:
+    """Spatial index over bounding boxes of connected components in a figure.
+
+    The image plane is divided into a uniform grid of square cells and each component is registered in every cell its
+    bounding box overlaps. A query only inspects components registered in cells around the query box, which are then
+    checked exactly. Results are returned in the same order as in the indexed sequence of panels.
+
+    :param panels: panels to index (usually `Figure.connected_components`)
+    :type panels: Sequence[Panel]
+    :param cell_size: side length of a grid cell in pixels; if not given, it is derived from the size of components
+    :type cell_size: int
+    """
+    MIN_CELL_SIZE = 8
+
+    def __init__(self, panels: Sequence['Panel'], cell_size: int = None):
+        self.panels = list(panels)
+        self._array = PanelArray(self.panels)
+        coords = self._array.coords
+        if cell_size is None:
+            cell_size = self.MIN_CELL_SIZE
+            if len(self.panels):
+                dims = np.maximum(coords[:, 2] - coords[:, 0], coords[:, 3] - coords[:, 1])
+                cell_size = max(int(np.median(dims)) * 2, self.MIN_CELL_SIZE)
+        self.cell_size = cell_size
+
+        row_start, col_start = self._to_cell(coords[:, 0]), self._to_cell(coords[:, 1])
+        row_end, col_end = self._to_cell(coords[:, 2]), self._to_cell(coords[:, 3])
+        self.num_rows = int(row_end.max()) + 1 if len(self.panels) else 1
+        self.num_cols = int(col_end.max()) + 1 if len(self.panels) else 1
+
+        # Enumerate all (cell, component) memberships and store them sorted by cell in a CSR-like layout
+        num_cols_spanned = col_end - col_start + 1
+        counts = (row_end - row_start + 1) * num_cols_spanned
+        member_idx = np.repeat(np.arange(len(self.panels)), counts)
+        within_block = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        rows = np.repeat(row_start, counts) + within_block // np.repeat(num_cols_spanned, counts)
+        cols = np.repeat(col_start, counts) + within_block % np.repeat(num_cols_spanned, counts)
+        cell_ids = rows * self.num_cols + cols
+        order = np.argsort(cell_ids, kind='stable')
+        self._members = member_idx[order]
+        self._offsets = np.searchsorted(cell_ids[order], np.arange(self.num_rows * self.num_cols + 1))
+
+    def __len__(self):
+        return len(self.panels)
+
+    def _to_cell(self, values):
+        return np.floor_divide(np.asarray(values, dtype=np.int64), self.cell_size)
+
+    def _candidates(self, top, left, bottom, right) -> np.ndarray:
+        """Indices of all components registered in grid cells overlapping the (top, left, bottom, right) region"""
+        row_start, row_end = np.clip(self._to_cell([top, bottom]), 0, self.num_rows - 1)
+        col_start, col_end = np.clip(self._to_cell([left, right]), 0, self.num_cols - 1)
+        if not len(self.panels) or bottom < 0 or right < 0:
+            return np.empty(0, dtype=np.int64)
+        # Cells within a single grid row are contiguous in the layout
+        members = [self._members[self._offsets[row * self.num_cols + col_start]:
+                                 self._offsets[row * self.num_cols + col_end + 1]]
+                   for row in range(row_start, row_end + 1)]
+        return np.unique(np.concatenate(members))
+
+    @staticmethod
+    def _query_coords(rect):
+        if hasattr(rect, 'panel'):
+            rect = rect.panel
+        return tuple(rect)
+
+    def _select(self, indices: np.ndarray, mask: np.ndarray) -> List['Panel']:
+        return [self.panels[idx] for idx in indices[mask]]
+
+    def contained_in(self, rect: 'Rect') -> List['Panel']:
+        """Returns all components whose bounding boxes lie entirely within `rect`"""
+        top, left, bottom, right = self._query_coords(rect)
+        idx = self._candidates(top, left, bottom, right)
+        t, l, b, r = self._array.coords[idx].T
+        return self._select(idx, (l >= left) & (r <= right) & (t >= top) & (b <= bottom))
+
+    def containing(self, rect: 'Rect') -> List['Panel']:
+        """Returns all components whose bounding boxes contain `rect`"""
+        top, left, bottom, right = self._query_coords(rect)
+        idx = self._candidates(top, left, top, left)
+        t, l, b, r = self._array.coords[idx].T
+        return self._select(idx, (left >= l) & (right <= r) & (top >= t) & (bottom <= b))
+
+    def overlapping(self, rect: 'Rect') -> List['Panel']:
+        """Returns all components whose bounding boxes overlap `rect` (see `Rect.overlaps`)"""
+        top, left, bottom, right = self._query_coords(rect)
+        idx = self._candidates(top, left, bottom, right)
+        t, l, b, r = self._array.coords[idx].T
+        return self._select(idx, (np.minimum(r, right) > np.maximum(l, left)) &
+                            (np.minimum(b, bottom) > np.maximum(t, top)))
+
+    def within_distance(self, rect: 'Rect', distance: float) -> List['Panel']:
+        """Returns all components whose edge separation from `rect` is at most `distance`. The separation is measured
+        from `rect` to each component, i.e. as `rect.edge_separation(cc)`. `Rect.edge_separation` is not symmetric,
+        so `cc.edge_separation(rect)` can select a different set of components
+        :param rect: query box
+        :type rect: Rect
+        :param distance: maximum edge separation
+        :type distance: float
+        :return: components within `distance` of `rect`
+        :rtype: list[Panel]"""
+        top, left, bottom, right = self._query_coords(rect)
+        idx = self._candidates(top - distance, left - distance, bottom + distance, right + distance)
+        dists = PanelArray([Rect((top, left, bottom, right))]).edge_separation(self._array.take(idx))[0]
+        return self._select(idx, dists <= distance)
+
 
 class Figure(object):
     """A class describing the processed figure."""
@@ -606,12 +954,15 @@ class Figure(object):
         :param numpy.ndarray labelled_img: an array of tags returned by the routine searching for connected components 
         """
         self._connected_components = None
+        self._cc_table = None
+        self._cc_index = None
+        self._pixel_index = None
         self._img = None
         self.eager_cc_init = eager_cc_init
         self._img = img
         self.raw_img = raw_img
         self.img_detectron = img_detectron
-        self.labelled_img = None
+        self._labelled_img = None
         self.single_bond_length = None
         self.width, self.height = img.shape[1], img.shape[0]
         self.center = (int(self.width * 0.5), int(self.height) * 0.5)
@@ -624,12 +975,35 @@ class Figure(object):
     @property
     def connected_components(self):
         if self._connected_components is None:
-            self.set_connected_components()
+            self._connected_components = self.cc_table.panels
         return self._connected_components
 
     @connected_components.setter
     def connected_components(self, value):
-        self._connected_components = value
+        self._connected_components = list(value)
+        self._cc_table = ConnectedComponentTable.from_panels(self, self._connected_components)
+        self._cc_index = None
+
+    @property
+    def cc_table(self):
+        """Columnar table of connected components, computed lazily on first access"""
+        if self._cc_table is None:
+            self.set_connected_components()
+        return self._cc_table
+
+    @property
+    def labelled_img(self):
+        """Array of connected component labels of `self.img`, computed lazily on first access"""
+        if self._labelled_img is None:
+            self.set_connected_components()
+        return self._labelled_img
+
+    @property
+    def cc_index(self):
+        """Spatial index over bounding boxes of `self.connected_components`, built lazily on first use"""
+        if self._cc_index is None:
+            self._cc_index = ConnectedComponentIndex(self.connected_components)
+        return self._cc_index
 
     @property
     def scaling_factor(self):
@@ -637,11 +1011,8 @@ class Figure(object):
 
     @img.setter
     def img(self, value):
-        if self._img is None:
-            self._img = value
-        else:
-            self._img = value
-            self.set_connected_components()
+        self._img = value
+        self._invalidate_connected_components()
 
     def __repr__(self):
         return '<%s>' % self.__class__.__name__
@@ -668,23 +1039,85 @@ class Figure(object):
 
         return Panel((0, 0, self.img.shape[0], self.img.shape[1]))
 
+    def derive(self, img: np.ndarray) -> 'Figure':
+        """Creates a shallow copy of the figure with its image replaced by `img` of the same shape.
+        Unchanged buffers (`raw_img`, `img_detectron`) and the scaling factor are shared by reference, while all data
+        derived from the image (connected components, labels and indices) is recomputed lazily on first access.
+        The type of the figure is preserved, so that derived crops keep their link to the main figure
+        :param img: new image
+        :type img: np.ndarray
+        :return: new figure sharing unchanged buffers with this figure
+        :rtype: Figure
+        """
+        derived = copy.copy(self)
+        derived._img = img
+        derived._invalidate_connected_components()
+        return derived
+
+    def _invalidate_connected_components(self):
+        """Drops connected components and all data derived from them"""
+        self._connected_components = None
+        self._cc_table = None
+        self._labelled_img = None
+        self._cc_index = None
+        self._pixel_index = None
+
     def set_connected_components(self):
         """
         Convenience function that tags ccs in an img and creates their Panels
         :return set: set of Panels of connected components
         """
-        panels = []
-        _, labelled, stats, _ = cv2.connectedComponentsWithStats(cv2.threshold
+        _, labelled, stats, centroids = cv2.connectedComponentsWithStats(cv2.threshold
                                                           (self.img, *ProcessorConfig.BIN_THRESH, cv2.THRESH_BINARY)[1],
                                                           connectivity=8)
-        self.labelled_img = labelled
-        for label, cc_stat in enumerate(stats):
-            x1, y1, w, h, _ = cc_stat
-            if w*h < self.area * 0.95:  # Spurious cc encompassing the whole image is sometimes produced
-                x2, y2 = x1 + w, y1 + h
-                panels.append(Panel((y1, x1, y2, x2), fig=self, tags=[label]))
-
-        self._connected_components = panels
+        self._labelled_img = labelled
+        self._pixel_index = None
+        self._cc_table = ConnectedComponentTable.from_stats(self, stats, centroids)
+        self._connected_components = None
+        self._cc_index = None
+
+    def inherit_connected_components(self, source: 'Figure', erased_labels: Collection) -> None:
+        """Sets connected components of this figure from `source`, whose image differs from `self.img` only by
+        connected components with `erased_labels` having been switched off. Erasing whole components does not change
+        connectivity of the remaining ones, so the labelling of `source` is reused instead of labelling the image again
+        :param source: figure from which `self.img` was derived by erasing connected components
+        :type source: Figure
+        :param erased_labels: labels of the erased connected components in `source`
+        :type erased_labels: Collection[int]
+        """
+        labelled = source.labelled_img.copy()
+        for label in erased_labels:
+            labelled[source.label_pixels(label)] = 0
+        table = source.cc_table
+        keep = ~np.isin(table.labels, list(erased_labels))
+        self._labelled_img = labelled
+        self._pixel_index = None
+        self._cc_table = ConnectedComponentTable(self, table.labels[keep], table.boxes[keep], table.pixel_areas[keep],
+                                                 table.centroids[keep], exact_pixel_areas=table.exact_pixel_areas)
+        self._connected_components = None
+        self._cc_index = None
+
+    def label_pixels(self, label: int) -> Tuple[np.ndarray]:
+        """Returns all pixels marked with `label` in `self.labelled_img`.
+        Foreground pixels are grouped by label once per labelling, after which every lookup is a slice proportional
+        to the size of the connected component
+        :param label: label of a connected component
+        :type label: int
+        :return: (rows, cols) arrays of pixel coordinates in row-major order
+        :rtype: tuple[np.ndarray]"""
+        if label == 0:  # Background is not indexed
+            return np.nonzero(self.labelled_img == 0)
+        if self._pixel_index is None:
+            flat_labels = self.labelled_img.ravel()
+            foreground = np.flatnonzero(flat_labels)
+            order = foreground[np.argsort(flat_labels[foreground], kind='stable')]
+            counts = np.bincount(flat_labels[foreground], minlength=int(flat_labels.max()) + 1)
+            offsets = np.concatenate(([0], np.cumsum(counts)))
+            self._pixel_index = order, offsets
+        order, offsets = self._pixel_index
+        if not 0 < label < len(offsets) - 1:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        return np.divmod(order[offsets[label]:offsets[label + 1]], self.labelled_img.shape[1])
 
     def resize(self, *args,  eager_cc_init=True, **kwargs):
         """Simple wrapper around opencv resize"""
@@ -692,8 +1125,7 @@ class Figure(object):
 
     def set_roles(self, panels, role):
         for panel in panels:
-            parent_cc = [cc for cc in self.connected_components if cc.contains(panel)]
-            for cc in parent_cc:
+            for cc in self.cc_index.containing(panel):
                 cc.role = role
 
 
@@ -715,6 +1147,8 @@ class Crop(Figure):
         self._top_padding = 0
         self._left_padding = 0
         self.cropped_rect = None  # Actual rectangle used for the crop - different if crop_params are out of fig bounds
+        self._main_img = None  # Main figure img at the time of cropping and its slice - used to reuse main fig labels
+        self._main_img_slice = None
         self._crop_main_figure()
 
     def pad_crop(self, pad_width: Union[Sequence, int]) -> 'Crop':
@@ -725,17 +1159,42 @@ class Crop(Figure):
         :rtype: Crop
         """
 
-        self.img = np.pad(self.img, pad_width=pad_width)
+        self.img = np.pad(self.img, pad_width=pad_width)  # ccs are recomputed lazily in the padded coordinates
         self.padding = pad_width
         self._top_padding = pad_width if isinstance(pad_width, int) else pad_width[0][0]
         self._left_padding = pad_width if isinstance(pad_width, int) else pad_width[1][0]
 
-        for cc in self.connected_components:
-            cc.top, cc.bottom = cc.top + self._top_padding, cc.bottom + self._top_padding
-            cc.left, cc.right = cc.left + self._left_padding, cc.right + self._left_padding
-
         return self
 
+    def set_connected_components(self):
+        """Sets connected components of the crop. If the crop image is an unchanged slice of an already labelled main
+        figure, the components are taken from the main figure labelling, with their boxes clipped to the crop and
+        translated to the in-crop coordinate system (pixel areas and centroids refer to whole components). Otherwise, the crop image is labelled anew
+        """
+        main_figure = self.main_figure
+        if (self._img is not self._main_img_slice or main_figure.img is not self._main_img
+                or main_figure._labelled_img is None):
+            super().set_connected_components()
+            return
+
+        top, left, bottom, right = self.cropped_rect.coords
+        labelled = main_figure.labelled_img[top:bottom, left:right]
+        table = main_figure.cc_table
+        present = np.isin(table.labels, np.unique(labelled))
+        height, width = labelled.shape
+        boxes = np.clip(table.boxes - [top, left, top, left], 0, [height, width, height, width])
+        # As when labelling anew, a component spanning (almost) the whole crop is treated as spurious
+        box_areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        present &= box_areas < self.area * 0.95
+        boxes = boxes[present]
+
+        self._labelled_img = labelled
+        self._pixel_index = None
+        self._cc_table = ConnectedComponentTable(self, table.labels[present], boxes, table.pixel_areas[present],
+                                                 table.centroids[present] - [left, top], exact_pixel_areas=False)
+        self._connected_components = None
+        self._cc_index = None
+
     def in_main_fig(self, element: Union['Panel', 'Point']) -> Union['Panel', 'Point']:
         """
         Transforms coordinates of ``cc`` (from ``self.connected_components``) to give coordinates of the
@@ -807,5 +1266,7 @@ class Crop(Figure):
         self.cropped_rect = Rect((top, left, bottom, right))
 
         super().__init__(out_img, out_raw_img, img_detectron=out_detectron_img)
+        self._main_img = img
+        self._main_img_slice = out_img
         if img_detectron is not None:
             self._scaling_factor = self.main_figure.scaling_factor
@@ -1,5 +1,4 @@
 import os
-from copy import deepcopy
 from enum import Enum, auto
 from abc import ABC, abstractmethod
 import imageio as imageio
@@ -178,9 +177,7 @@ class Binariser(ImageProcessor):
         """Binarises gray images"""
         if self.color_mode == self.COLOR_MODE.GRAY:
             ret, img = cv2.threshold(self.img, *self.bin_thresh, cv2.THRESH_BINARY)
-            fig_copy = deepcopy(self.fig)
-            fig_copy.img = img
-            return fig_copy
+            return self.fig.derive(img)
 
 
 class Isolator(ImageProcessor):
@@ -200,9 +197,7 @@ class Isolator(ImageProcessor):
         mask[rows, cols] = True
         isolated_cc_img = np.zeros_like(self.img, dtype=np.uint8)
         isolated_cc_img[mask] = self.img[mask]
-        fig_copy = deepcopy(self.fig)
-        fig_copy.img = isolated_cc_img
-        return fig_copy
+        return self.fig.derive(isolated_cc_img)
 
     def process(self):
         """Isolates connected components either by using their panels or pixel-wise masks"""
@@ -11,8 +11,12 @@ email: dmw51@cam.ac.uk
 Recognition is achieved using OSRA and performed via a pyOsra wrapper.
 """
 import os
+import hashlib
 import itertools
 import logging
+import sqlite3
+import time
+from typing import Dict, List, Tuple
 from PIL import Image
 
 import cv2
@@ -23,6 +27,10 @@ import efficientnet.tfkeras as efn
 
 from DECIMER.config import get_bnw_image, delete_empty_borders, central_square_image, PIL_im_to_BytesIO, get_resize, increase_contrast
 from DECIMER.decimer import tokenizer, DECIMER_V2
+import DECIMER
+
+from configs.config import ExtractorConfig
+from utils.resources import resolve_num_threads
 
 from models.reaction import Diagram
 from reactiondataextractor.models.segments import FigureRoleEnum, Figure
@@ -32,10 +40,138 @@ log = logging.getLogger()
 
 
 class DecimerRecogniser:
-    def __init__(self, model_id='Canonical'):
+    # Channel statistics used by `efn.preprocess_input` to normalise model inputs
+    INPUT_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+    INPUT_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+    # Inference backends - the exported model, or its encoder and decoder driven step by step, with the encoder compiled
+    # with XLA or converted to TFLite with float16 or int8 weights
+    BACKENDS = ['saved_model', 'xla', 'tflite_fp16', 'tflite_int8']
+    # Version of the preprocessing in `decode_images`, to be increased whenever its output changes
+    PREPROCESSING_VERSION = 2
+
+    def __init__(self, model_id='Canonical', backend=ExtractorConfig.DECIMER_BACKEND,
+                 max_decode_length=ExtractorConfig.DECIMER_MAX_DECODE_LENGTH):
         assert model_id.capitalize() in ['Canonical', 'Isomeric', 'Augmented'], "model_id has to be one of the following:\
                                                                             ['Canonical', 'Isomeric', 'Augmented']"
+        assert backend in self.BACKENDS, f"backend has to be one of the following: {self.BACKENDS}"
+        self.model_id = model_id.capitalize()
         self.model = DECIMER_V2
+        self.backend = backend
+        self.max_decode_length = max_decode_length
+        self._predict = self._create_predictor(backend)
+
+    @property
+    def fingerprint(self) -> str:
+        """Identifies the recognition model, so that cached predictions of different models are never mixed"""
+        fingerprint = (f"DECIMER-{getattr(DECIMER, '__version__', 'unknown')}-{self.model_id}-{self.backend}-"
+                       f"preprocessing{self.PREPROCESSING_VERSION}")
+        if self.backend != 'saved_model':
+            fingerprint += f'-{self.max_decode_length}'
+        return fingerprint
+
+    def predict(self, model_input: 'Tensor') -> Tuple['Tensor', 'Tensor']:
+        """
+        Predicts tokens for a single preprocessed image using the selected backend
+        :param model_input: preprocessed image of shape [512, 512, 3]
+        :type model_input: Tensor
+        :return: predicted tokens of shape [1, n_tokens] and their confidences
+        :rtype: Tuple[Tensor, Tensor]
+        """
+        return self._predict(model_input)
+
+    def _create_predictor(self, backend: str):
+        """Prepares the model for inference using `backend` and returns a function mapping a preprocessed image to
+        predicted tokens and their confidences.
+
+        The 'saved_model' backend calls the exported model, whose decoding loop and maximum length are fixed. Other
+        backends run the encoder once and the decoder step by step, stopping at the end token or after
+        `self.max_decode_length` tokens. Tokens are decoded in a buffer whose length grows in steps of
+        `ExtractorConfig.DECIMER_DECODE_BUCKET_LENGTH`, so that the decoder step is compiled once per bucket rather
+        than once per token, while its cost follows the decoded length. The look-ahead mask keeps the predictions equal
+        to those of the exported model.
+        :param backend: one of `self.BACKENDS`
+        :type backend: str
+        :return: function running the model on a single image
+        :rtype: Callable[[Tensor], Tuple[Tensor, Tensor]]
+        """
+        if backend == 'saved_model':
+            return self.model
+
+        from DECIMER.Transformer_decoder import create_masks_decoder
+
+        # The exported module wraps the predictor holding the encoder and the decoder
+        predictor = getattr(self.model, 'DECIMER', self.model)
+        encoder, transformer = predictor.encoder, predictor.transformer
+        start_token, end_token = tokenizer.word_index['<start>'], tokenizer.word_index['<end>']
+        max_length = self.max_decode_length
+        bucket_length = ExtractorConfig.DECIMER_DECODE_BUCKET_LENGTH
+
+        if backend == 'xla':
+            encode = tf.function(lambda img_batch: encoder(img_batch, training=False), jit_compile=True)
+        else:
+            encode = self._create_tflite_encoder(encoder, backend)
+
+        @tf.function(jit_compile=True)
+        def decode_step(tokens, image_embedding, t):
+            predictions = transformer(tokens, image_embedding, training=False,
+                                      look_ahead_mask=create_masks_decoder(tokens))
+            predicted_id = tf.cast(tf.argmax(predictions[0, t]), tf.int32)
+            return predicted_id, predictions[0, t, predicted_id]
+
+        def predict(model_input):
+            image_embedding = encode(tf.expand_dims(tf.cast(model_input, tf.float32), 0))
+            tokens = np.zeros((1, max_length + 1), dtype=np.int32)
+            tokens[0, 0] = start_token
+            confidences = []
+            for t in range(max_length):
+                buffer_length = min(-(-(t + 1) // bucket_length) * bucket_length, max_length + 1)
+                predicted_id, confidence = decode_step(tf.constant(tokens[:, :buffer_length]), image_embedding,
+                                                       tf.constant(t))
+                tokens[0, t + 1] = int(predicted_id)
+                confidences.append(float(confidence))
+                if tokens[0, t + 1] == end_token:
+                    break
+            return tf.constant(tokens[:, :len(confidences) + 1]), tf.constant(confidences, dtype=tf.float32)
+
+        return predict
+
+    def _create_tflite_encoder(self, encoder, backend: str):
+        """Converts the encoder to TFLite with weights quantised according to `backend` and returns a function running
+        it. The converted model is stored in `ExtractorConfig.DECIMER_TFLITE_DIR` and reused in subsequent runs.
+        :param encoder: encoder of the DECIMER model
+        :type encoder: tf.Module
+        :param backend: 'tflite_fp16' or 'tflite_int8'
+        :type backend: str
+        :return: function mapping a batch of one preprocessed image to its embedding
+        :rtype: Callable[[Tensor], Tensor]
+        """
+        os.makedirs(ExtractorConfig.DECIMER_TFLITE_DIR, exist_ok=True)
+        tflite_path = os.path.join(ExtractorConfig.DECIMER_TFLITE_DIR,
+                                   f"decimer_encoder_{getattr(DECIMER, '__version__', 'unknown')}_{self.model_id}_"
+                                   f"{backend}.tflite")
+        if not os.path.exists(tflite_path):
+            encode = tf.function(lambda img_batch: encoder(img_batch, training=False))
+            concrete_encode = encode.get_concrete_function(tf.TensorSpec([1, 512, 512, 3], tf.float32))
+            converter = tf.lite.TFLiteConverter.from_concrete_functions([concrete_encode], encoder)
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]  # int8 weights unless another type is given
+            if backend == 'tflite_fp16':
+                converter.target_spec.supported_types = [tf.float16]
+            with open(tflite_path, 'wb') as f:
+                f.write(converter.convert())
+            log.info(f'DECIMER encoder converted to TFLite: {tflite_path}')
+
+        interpreter = tf.lite.Interpreter(model_path=tflite_path, num_threads=resolve_num_threads())
+        interpreter.allocate_tensors()
+        input_index = interpreter.get_input_details()[0]['index']
+        output_index = interpreter.get_output_details()[0]['index']
+
+        def encode(img_batch):
+            interpreter.set_tensor(input_index, np.asarray(img_batch, dtype=np.float32))
+            interpreter.invoke()
+            return tf.constant(interpreter.get_tensor(output_index))
+
+        return encode
 
     def decode_image(self, img: np.ndarray) -> 'Tensor':
         """
@@ -55,6 +191,71 @@ class DecimerRecogniser:
         img = efn.preprocess_input(img)
         return img
 
+    def decode_images(self, imgs: List[np.ndarray]) -> 'Tensor':
+        """
+        Preprocesses a batch of images directly from their arrays. This is equivalent to calling `decode_image` on
+        each image, but avoids the conversions to PIL images and the PNG encoding and decoding round trip. Grayscale
+        images of the same size are resized together, and all images are normalised in a single call.
+        :param imgs: image arrays for preprocessing
+        :type imgs: List[np.ndarray]
+        :return: preprocessed images of shape [n_images, 512, 512, 3]
+        :rtype: Tensor
+        """
+        squares = [self._preprocess_array(img) for img in imgs]
+        indices_by_size = {}
+        for idx, square in enumerate(squares):
+            indices_by_size.setdefault(square.shape, []).append(idx)
+
+        resized = [None] * len(squares)
+        for indices in indices_by_size.values():
+            batch = np.stack([squares[idx] for idx in indices])[..., np.newaxis]
+            batch = tf.image.resize(batch, (512, 512), method="gaussian", antialias=True)
+            for idx, img in zip(indices, tf.unstack(batch)):
+                resized[idx] = img
+
+        # Equivalent to `efn.preprocess_input` applied to the grayscale image repeated over three channels
+        batch = tf.stack(resized) / 255.
+        return (batch - self.INPUT_MEAN) / self.INPUT_STD
+
+    @staticmethod
+    def _preprocess_array(img: np.ndarray) -> np.ndarray:
+        """
+        Performs the steps of `decode_image` preceding the PNG encoding directly on an image array: contrast
+        stretching, conversion to grayscale with enhanced contrast, upscaling of small images, removal of empty borders
+        and padding to a central square.
+        :param img: image array for preprocessing
+        :type img: np.ndarray
+        :return: preprocessed uint8 grayscale square image
+        :rtype: np.ndarray
+        """
+        img = np.asarray(img)
+        min_val, max_val = int(img.min()), int(img.max())
+        lut = np.zeros(256, dtype=np.uint8)
+        lut[min_val:max_val + 1] = np.linspace(0, 255, num=max_val - min_val + 1, endpoint=True, dtype=np.uint8)
+        img = lut[img]
+
+        if img.ndim == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        mean = np.float32(int(img.mean() + 0.5))
+        img = np.clip(mean + np.float32(1.8) * (img - mean), 0, 255).astype(np.uint8)
+
+        # Small images are upscaled by DECIMER itself, since its PIL filters and rounding of sizes differ from OpenCV's
+        height, width = img.shape
+        if width < 512 and height < 512:
+            img = np.asarray(get_resize(Image.fromarray(img)))
+
+        ink = img <= 200
+        rows, cols = np.flatnonzero(ink.any(axis=1)), np.flatnonzero(ink.any(axis=0))
+        if rows.size:
+            img = img[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+
+        height, width = img.shape
+        side = max(int(1.2 * max(height, width)), 512)
+        square = np.full((side, side), 255, dtype=np.uint8)
+        top, left = int((side - height) / 2), int((side - width) / 2)
+        square[top:top + height, left:left + width] = img
+        return square
+
     def detokenize_output(self, predicted_array: 'Tensor') -> str:
         """
         This function takes the predited tokens from the DECIMER model
@@ -87,5 +288,109 @@ class DecimerRecogniser:
 
     
 
-        return prediction
-    
+
+class SmilesCache:
+    """Persistent cache of recognised SMILES, stored in an SQLite database.
+
+    Entries are keyed by a hash of the preprocessed model input together with the fingerprint of the recognition model.
+    The database is used in write-ahead logging mode, so that several worker processes can read it at once while
+    another one writes. When the number of entries exceeds `max_entries`, the least recently used ones are evicted.
+
+    :param path: path to the database file
+    :type path: str
+    :param model_fingerprint: identifier of the model whose predictions are cached
+    :type model_fingerprint: str
+    :param max_entries: maximum number of cached entries
+    :type max_entries: int
+    """
+    # Maximum number of keys in a single query, below the default SQLite limit of host parameters
+    _MAX_QUERY_PARAMS = 900
+
+    def __init__(self, path: str = ExtractorConfig.SMILES_CACHE_PATH, model_fingerprint: str = '',
+                 max_entries: int = ExtractorConfig.SMILES_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.model_fingerprint = model_fingerprint
+        self.max_entries = max_entries
+        self._connection = None
+        self._connection_pid = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """Connection to the database, opened lazily. Connections are not shared with forked worker processes"""
+        if self._connection is None or self._connection_pid != os.getpid():
+            dirname = os.path.dirname(self.path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=ExtractorConfig.SMILES_CACHE_TIMEOUT)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            with connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS smiles_cache '
+                                   '(key TEXT PRIMARY KEY, smiles TEXT NOT NULL, last_used REAL NOT NULL)')
+                connection.execute('CREATE INDEX IF NOT EXISTS smiles_cache_last_used ON smiles_cache (last_used)')
+            self._connection = connection
+            self._connection_pid = os.getpid()
+        return self._connection
+
+    def key(self, model_input: 'Tensor') -> str:
+        """Computes the cache key of a preprocessed model input
+
+        :param model_input: preprocessed image, as returned by `DecimerRecogniser.decode_images`
+        :type model_input: Tensor
+        :return: cache key
+        :rtype: str
+        """
+        model_input = np.ascontiguousarray(np.asarray(model_input))
+        digest = hashlib.blake2b(self.model_fingerprint.encode(), digest_size=20)
+        digest.update(str(model_input.shape).encode())
+        digest.update(model_input.tobytes())
+        return digest.hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, str]:
+        """Looks up cached SMILES and marks the found entries as recently used
+
+        :param keys: cache keys
+        :type keys: List[str]
+        :return: mapping from the found keys to their SMILES
+        :rtype: Dict[str, str]
+        """
+        keys = list(keys)
+        found = {}
+        for idx in range(0, len(keys), self._MAX_QUERY_PARAMS):
+            chunk = keys[idx:idx + self._MAX_QUERY_PARAMS]
+            query = f"SELECT key, smiles FROM smiles_cache WHERE key IN ({', '.join('?' * len(chunk))})"
+            found.update(self.connection.execute(query, chunk).fetchall())
+        if found:
+            try:
+                with self.connection:
+                    self.connection.executemany('UPDATE smiles_cache SET last_used = ? WHERE key = ?',
+                                                [(time.time(), key) for key in found])
+            except sqlite3.OperationalError as e:
+                # Recency is only used for eviction, so a busy database is not an error here
+                log.debug(f'Could not update recency of cached SMILES: {e}')
+        return found
+
+    def put_many(self, smiles: Dict[str, str]) -> None:
+        """Stores recognised SMILES and evicts the least recently used entries above `max_entries`
+
+        :param smiles: mapping from cache keys to SMILES
+        :type smiles: Dict[str, str]
+        """
+        if not smiles:
+            return
+        now = time.time()
+        try:
+            with self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO smiles_cache (key, smiles, last_used) VALUES (?, ?, ?)',
+                                            [(key, value, now) for key, value in smiles.items()])
+                self.connection.execute('DELETE FROM smiles_cache WHERE key IN (SELECT key FROM smiles_cache '
+                                        'ORDER BY last_used DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+        except sqlite3.OperationalError as e:
+            log.warning(f'Could not store SMILES in the cache: {e}')
+
+    def close(self) -> None:
+        """Closes the connection to the database"""
+        if self._connection is not None and self._connection_pid == os.getpid():
+            self._connection.close()
+        self._connection = None
+        self._connection_pid = None
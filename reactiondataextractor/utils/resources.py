@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Resources
+=========
+This module contains routines used to share CPU resources between the libraries used in extraction. Each of torch,
+TensorFlow, OpenCV and Tesseract uses all cores by default, which oversubscribes the machine when several extraction
+processes run at once.
+author: Damian Wilary
+email: dmw51@cam.ac.uk
+"""
+import logging
+import os
+from typing import Optional, Tuple
+
+from configs.config import ResourceConfig
+
+log = logging.getLogger('extract.resources')
+
+# Variables read by OpenMP, BLAS and TensorFlow runtimes (including Tesseract's) when they are initialised
+THREAD_ENV_VARIABLES = ['OMP_NUM_THREADS', 'OMP_THREAD_LIMIT', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                        'TF_NUM_INTRAOP_THREADS']
+# Variables identifying the current worker, set by whatever launches the worker processes
+WORKER_INDEX_ENV_VARIABLE = 'RDE_WORKER_INDEX'
+NUM_WORKERS_ENV_VARIABLE = 'RDE_NUM_WORKERS'
+
+# Number of threads set by the last call to `apply_resource_limits`
+_applied_num_threads = None
+
+
+def resolve_worker(worker_index: Optional[int] = None, num_workers: Optional[int] = None) -> Tuple[int, int]:
+    """Returns the index of the current worker and the number of workers. Values which are not given are read from
+    the RDE_WORKER_INDEX and RDE_NUM_WORKERS environment variables, and default to 0 and `ResourceConfig.NUM_WORKERS`
+
+    :param worker_index: index of the current worker
+    :type worker_index: Optional[int]
+    :param num_workers: number of extraction processes running at once
+    :type num_workers: Optional[int]
+    :return: worker index and number of workers
+    :rtype: Tuple[int, int]
+    """
+    if worker_index is None:
+        worker_index = int(os.environ.get(WORKER_INDEX_ENV_VARIABLE, 0))
+    if num_workers is None:
+        num_workers = int(os.environ.get(NUM_WORKERS_ENV_VARIABLE, ResourceConfig.NUM_WORKERS))
+    return worker_index, num_workers
+
+
+def resolve_num_threads(num_workers: Optional[int] = None,
+                        num_threads: Optional[int] = ResourceConfig.NUM_THREADS) -> int:
+    """Returns the number of threads each worker should use. Without arguments, this is the number set by
+    `apply_resource_limits` if it has been called. Otherwise, it is `num_threads` if given, or an even share of
+    available cores. All thread pools and libraries in a worker should be sized using this function
+
+    :param num_workers: number of extraction processes running at once, read as in `resolve_worker` if None
+    :type num_workers: Optional[int]
+    :param num_threads: requested number of threads per worker
+    :type num_threads: Optional[int]
+    :return: number of threads per worker
+    :rtype: int
+    """
+    if num_workers is None and num_threads == ResourceConfig.NUM_THREADS and _applied_num_threads:
+        return _applied_num_threads
+    if num_threads:
+        return num_threads
+    _, num_workers = resolve_worker(num_workers=num_workers)
+    return max(os.cpu_count() // max(num_workers, 1), 1)
+
+
+def apply_resource_limits(worker_index: Optional[int] = None,
+                          num_workers: Optional[int] = None,
+                          num_threads: Optional[int] = ResourceConfig.NUM_THREADS,
+                          num_interop_threads: int = ResourceConfig.NUM_INTEROP_THREADS,
+                          pin_cpu_affinity: bool = ResourceConfig.PIN_CPU_AFFINITY) -> int:
+    """Sets threading of torch, TensorFlow, OpenCV and OpenMP consistently for the current process. Should be called
+    as early as possible in each worker, ideally before TensorFlow is first used - TensorFlow threading cannot be
+    changed afterwards. Calling it again with the same arguments has no further effect.
+
+    :param worker_index: index of the current worker, used to select cores when pinning CPU affinity; read as in
+    `resolve_worker` if None
+    :type worker_index: Optional[int]
+    :param num_workers: number of extraction processes running at once, read as in `resolve_worker` if None
+    :type num_workers: Optional[int]
+    :param num_threads: number of threads per worker, cores are split evenly between workers if None
+    :type num_threads: Optional[int]
+    :param num_interop_threads: number of threads running independent operations in parallel in torch and TensorFlow
+    :type num_interop_threads: int
+    :param pin_cpu_affinity: whether to pin the current process to its own set of cores
+    :type pin_cpu_affinity: bool
+    :return: number of threads used by the current process
+    :rtype: int
+    """
+    global _applied_num_threads
+    worker_index, num_workers = resolve_worker(worker_index, num_workers)
+    num_threads = resolve_num_threads(num_workers, num_threads)
+
+    if pin_cpu_affinity:
+        if num_workers > 1 and WORKER_INDEX_ENV_VARIABLE not in os.environ and worker_index == 0:
+            log.warning(f'CPU affinity is pinned for {num_workers} workers, but no worker index was given - workers '
+                        f'pinned to the same cores will compete for them')
+        if hasattr(os, 'sched_setaffinity'):
+            cores = sorted(os.sched_getaffinity(0))
+            if len(cores) > num_threads:  # Not pinned yet
+                first = (worker_index * num_threads) % len(cores)
+                os.sched_setaffinity(0, {cores[(first + idx) % len(cores)] for idx in range(num_threads)})
+        else:
+            log.warning('CPU affinity pinning is not supported on this platform')
+
+    for variable in THREAD_ENV_VARIABLES:
+        os.environ[variable] = str(num_threads)
+    os.environ['TF_NUM_INTEROP_THREADS'] = str(num_interop_threads)
+
+    import cv2
+    import torch
+    import tensorflow as tf
+
+    _applied_num_threads = num_threads
+    cv2.setNumThreads(num_threads)
+    torch.set_num_threads(num_threads)
+    if torch.get_num_interop_threads() != num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:  # Can only be set before any parallel work is started
+            log.warning('torch inter-op threads could not be set - parallel work has already been started')
+
+    threading = tf.config.threading
+    if (threading.get_intra_op_parallelism_threads() != num_threads or
+            threading.get_inter_op_parallelism_threads() != num_interop_threads):
+        try:
+            threading.set_intra_op_parallelism_threads(num_threads)
+            threading.set_inter_op_parallelism_threads(num_interop_threads)
+        except RuntimeError:  # Can only be set before TensorFlow runtime is initialised
+            log.warning('TensorFlow threading could not be set - TensorFlow has already been initialised')
+
+    log.info(f'Worker {worker_index} uses {num_threads} threads ({num_interop_threads} inter-op threads)'
+             + (f', pinned to cores {sorted(os.sched_getaffinity(0))}' if pin_cpu_affinity and
+                hasattr(os, 'sched_getaffinity') else ''))
+    return num_threads
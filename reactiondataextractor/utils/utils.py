@@ -20,7 +20,7 @@ from scipy.stats import mode
 
 from configs import config
 from reactiondataextractor.models.geometry import Line, Point, OpencvToSkimageHoughLineAdapter
-from reactiondataextractor.models.segments import Rect, Panel, Figure, FigureRoleEnum
+from reactiondataextractor.models.segments import Rect, Panel, Figure, FigureRoleEnum, PanelArray
 
 
 class DisabledNegativeIndices:
@@ -168,18 +168,18 @@ def erase_elements(fig: 'Figure', elements: List['Panel'], copy_fig: bool=True)
     :return: _description_
     :rtype: Figure
     # """
+    # Only `img` is modified - other buffers are shared with `fig`
     if copy_fig:
-        temp_fig = copy.deepcopy(fig)
+        temp_fig = fig.derive(fig.img.copy())
     else:
-        img_copy = copy.deepcopy(fig.img)
-        raw_img = copy.deepcopy(fig.raw_img)
-        img_detectron = copy.deepcopy(fig.img_detectron)
-        temp_fig = Figure(img=img_copy, raw_img=raw_img, img_detectron=img_detectron)
+        temp_fig = Figure(img=fig.img.copy(), raw_img=fig.raw_img, img_detectron=fig.img_detectron)
         temp_fig._scaling_factor = fig.scaling_factor
-        
+
     for panel in elements:
         panel.mask_off(temp_fig)
-    temp_fig.set_connected_components()
+    if all(panel.tags and panel.fig is fig for panel in elements):
+        temp_fig.inherit_connected_components(fig, {tag for panel in elements for tag in panel.tags})
+    # Otherwise, connected components of `temp_fig` are labelled lazily, only if they are ever accessed
 
     return temp_fig
 
@@ -366,10 +366,8 @@ def skeletonize(fig):
     """
 
     img = cv2.ximgproc.thinning(fig.img)
-    fig_copy = copy.deepcopy(fig)
-    fig_copy.img = img
 
-    return fig_copy
+    return fig.derive(img)
 
 
 def skeletonize_area_ratio(fig, panel):
@@ -385,8 +383,13 @@ def skeletonize_area_ratio(fig, panel):
 def mark_tiny_ccs(fig):
     """Marks all tiny connected components
     :param Figure fig: Analysed figure"""
-    [setattr(cc, 'role', FigureRoleEnum.TINY) for cc in fig.connected_components if
-     cc.area < np.percentile([cc.area for cc in fig.connected_components], 4) and cc.role is None]
+    table = fig.cc_table
+    if not len(table):
+        return
+    areas = table.areas
+    tiny = (areas < np.percentile(areas, 4)) & np.equal(table.roles, None)
+    for idx in np.flatnonzero(tiny):
+        table.panel(idx).role = FigureRoleEnum.TINY
 
 
 def find_relative_directional_position(point1, point2):
@@ -422,38 +425,23 @@ def lies_along_arrow_normal(arrow, obj):
     Form 4 points, 2 at end of arrows (or extending a bit further), 2 extending from a line normal to the
     arrow's bounding box (minimal), and check which is closest. Reclassify as conditions if obj is closer to
     a normal point"""
-
-    # (x, y), (MA, ma), angle = cv2.minAreaRect(arrow.contour)
-    min_rect = cv2.minAreaRect(arrow.contour[0])
-    box_points = cv2.boxPoints(min_rect)
-    diffs = [box_points[idx+1] - box_points[idx] for idx in range(3)] + [box_points[0] - box_points[-1]]
-    box_segment_lengths = [np.sqrt(np.sum(np.power(x,2))) for x in diffs]
-    largest_idx = np.argmax(box_segment_lengths)
-    points = box_points[largest_idx], box_points[(largest_idx+1)%4]
-    x_diff = points[1][0] - points[0][0]
-    y_diff = points[1][1] - points[0][1]
-    eps  = 1e-5
-    dir_array = np.array([x_diff, y_diff])
-    direction_arrow = dir_array / np.linalg.norm(dir_array)
-
-    center = np.asarray(arrow.panel.center)
-    direction_normal = np.asarray([-1*direction_arrow[1], direction_arrow[0]])
-    dist = box_segment_lengths[largest_idx] / 2
-    p_a1, p_a2 = find_points_on_line(center, direction_arrow, distance=dist * 1.5)
-    p_n1, p_n2 = find_points_on_line(center, direction_normal, distance=dist * .5)
-    closest_pt = min([p_a1, p_a2, p_n1, p_n2], key=lambda pt: obj.center_separation(pt))
-    ## Visualize created points
-    # import matplotlib.pyplot as plt
-    # plt.imshow(self.fig.img)
-    # plt.scatter(p_a1[0], p_a1[1], c='r', s=3)
-    # plt.scatter(p_a2[0], p_a2[1], c='r', s=3)
-    # plt.scatter(p_n1[0], p_n1[1], c='b', s=3)
-    # plt.scatter(p_n2[0], p_n2[1], c='b', s=3)
-    # plt.show()
-
-    if any(np.array_equal(closest_pt, p) for p in [p_n1, p_n2]):
-        return True
-    return False
+    return bool(lies_along_arrow_normal_many(arrow, [obj])[0])
+
+
+def lies_along_arrow_normal_many(arrow, objs):
+    """Vectorised version of `lies_along_arrow_normal` checking multiple objects at once. Uses probe points cached
+    on the arrow
+    :param BaseArrow arrow: arrow around which objects are checked
+    :param list objs: panels or objects with `panel` attribute
+    :return: boolean array, True for objects lying along the arrow normal
+    :rtype: np.ndarray"""
+    if not len(objs):
+        return np.zeros(0, dtype=bool)
+    probe_points = arrow.probe_points
+    centers = PanelArray(objs).centers
+    dists = np.linalg.norm(centers[:, np.newaxis, :] - probe_points[np.newaxis, :, :], axis=-1)
+    closest_pts = probe_points[np.argmin(dists, axis=1)]
+    return (closest_pts == probe_points[2]).all(axis=1) | (closest_pts == probe_points[3]).all(axis=1)
 
 def compute_ioa(panel1, panel2):
     """Compute intersection of two bounding boxes represented by Panels,
@@ -1,12 +1,19 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
 import numpy as np
-from typing import List
+from typing import List, Tuple
 
 import cv2
 import potrace
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
 
 from configs import config
-from utils.utils import erase_elements, euclidean_distance, isolate_patches, HoughLinesP
+from utils.utils import erase_elements, isolate_patches, HoughLinesP
 from reactiondataextractor.configs import Config, ExtractorConfig
+from utils.resources import resolve_num_threads
+
+log = logging.getLogger('extract.vectorised')
 
 
 class DiagramVectoriser:
@@ -21,18 +28,50 @@ class DiagramVectoriser:
         as establishes the adjacency matrix
         """
         assert self.diag, "diagram for vectorisation has not been set"
+        self.diag.corners, self.diag.adjacency_matrix = self._vectorise_diagram(self.diag)
+
+    def create_vectorised_diagram_graphs(self, diags: List['Diagram']) -> None:
+        """Vectorises multiple diagrams at once. Their images are thinned and traced in a pool of threads.
+        Diagrams in figures without an estimated single bond length, and diagrams whose vectorisation fails, are skipped
+
+        :param diags: diagrams to vectorise
+        :type diags: List[Diagram]
+        """
+        diags = [diag for diag in diags if diag.panel.fig.single_bond_length]
+        def vectorise(diag):
+            try:
+                return self._vectorise_diagram(diag)
+            except Exception as e:
+                log.warning(f'Vectorisation of {diag.panel} failed: {e}')
+                return None
+
+        with ThreadPoolExecutor(max_workers=resolve_num_threads()) as executor:
+            graphs = list(executor.map(vectorise, diags))
+        for diag, graph in zip(diags, graphs):
+            if graph is not None:
+                diag.corners, diag.adjacency_matrix = graph
+
+    def _vectorise_diagram(self, diag: 'Diagram') -> Tuple[List[Tuple[float, float]], np.ndarray]:
+        """Finds corners of `diag` and their adjacency matrix
+
+        :param diag: diagram to vectorise
+        :type diag: Diagram
+        :return: corners and adjacency matrix between them
+        :rtype: Tuple[List[Tuple[float, float]], np.ndarray]
+        """
+        text_chars = getattr(diag, 'text_chars', [])
+        r_group_placeholders = getattr(diag, 'r_group_placeholders', [])
+        img = erase_elements(diag.crop, [char.panel for char in text_chars]+
+                             [r_group._lone_line for r_group in r_group_placeholders if r_group.lone], copy_fig=False).img
 
-        img = erase_elements(self.diag.crop, [char.panel for char in self.diag.text_chars]+
-                             [r_group._lone_line for r_group in self.diag.r_group_placeholders if r_group.lone], copy_fig=False).img
-        
         # Add corners for each heteroatom connecting carbon backbones inside the diagram
-        heteroatom_corners_to_add = [char.panel.center for char in self.diag.text_chars if char.text in ['O', 'N', 'S', 'P', 'F'] ]
-        corners = self.vectorise_image(img, self.diag.panel.fig.single_bond_length * 0.6, artificial_corners=heteroatom_corners_to_add)
-        
-        distance_matrix = np.array([[euclidean_distance(p1, p2) for p1 in corners] for p2 in corners])        
-        adjacency_matrix = self._create_adjacency_matrix(distance_matrix)
-        self.diag.corners = corners
-        self.diag.adjacency_matrix = adjacency_matrix
+        heteroatom_corners_to_add = [char.panel.center for char in text_chars if char.text in ['O', 'N', 'S', 'P', 'F'] ]
+        single_bond_length = diag.panel.fig.single_bond_length
+        corners = self.vectorise_image(img, single_bond_length * 0.6, artificial_corners=heteroatom_corners_to_add)
+
+        points = np.asarray(corners, dtype=float).reshape(-1, 2)
+        adjacency_matrix = self._create_adjacency_matrix(cdist(points, points), single_bond_length)
+        return corners, adjacency_matrix
 
     def vectorise_image(self, img: np.ndarray, corner_prune_dist:float, artificial_corners:List=[]) -> np.ndarray:
         """Uses potrace library to vectorise the image. Removes spurious detected corners. Adds one corner
@@ -58,35 +97,30 @@ class DiagramVectoriser:
         return corners
 
     def _remove_duplicate_corners(self, corners, thresh_dist, fixed_corners=[]):
-        "Removes duplicate, spurious corners"
-        duplicate_found = True
-        
-        while duplicate_found:
-            duplicate_found = False
-            for idx1 in range(len(corners)):
-                if corners[idx1] is not None:
-                    for idx2 in range(idx1+1, len(corners)):
-                        if corners[idx2] is not None and euclidean_distance(corners[idx1], corners[idx2]) < thresh_dist:
-                            duplicate_found = True
-                            if corners[idx1] in fixed_corners:
-                                new_x = corners[idx1][0]
-                                new_y = corners[idx1][1]
-                                corners[idx2] = None
-                            elif corners[idx2] in fixed_corners:
-                                new_x = corners[idx2][0]
-                                new_y = corners[idx2][1]
-                                corners[idx1] = None
-                                break
-                            else:
-                                new_x = (corners[idx1][0] + corners[idx2][0]) / 2
-                                new_y = (corners[idx1][1] + corners[idx2][1]) / 2
-                                corners[idx2] = None
-                            corners[idx1] = (new_x, new_y)
-                  
-        return [c for c in corners if c is not None]
-
-    def _create_adjacency_matrix(self, dst_matrix):
-        dst_matrix = dst_matrix / self.diag.panel.fig.single_bond_length * Config.SINGLE_BOND_LENGTH
+        """Removes duplicate, spurious corners. Corners closer than `thresh_dist` to a fixed corner are merged into it.
+        Each of the remaining corners, in order, is then merged with all unmerged corners closer than `thresh_dist`,
+        and the group is replaced by its mean position"""
+        if not corners:
+            return []
+        points = np.asarray(corners, dtype=float).reshape(-1, 2)
+        fixed_set = {tuple(corner) for corner in fixed_corners}
+        fixed = np.array([tuple(corner) in fixed_set for corner in corners])
+        tree = cKDTree(points)
+        radius = np.nextafter(thresh_dist, 0)  # Only corners strictly closer than `thresh_dist` are merged
+
+        merged = np.zeros(len(points), dtype=bool)
+        deduplicated = []
+        for idx in np.concatenate([np.flatnonzero(fixed), np.flatnonzero(~fixed)]):
+            if merged[idx]:
+                continue
+            group = [neighbour for neighbour in tree.query_ball_point(points[idx], radius) if not merged[neighbour]]
+            merged[group] = True
+            x, y = points[idx] if fixed[idx] else points[group].mean(axis=0)
+            deduplicated.append((x, y))
+        return deduplicated
+
+    def _create_adjacency_matrix(self, dst_matrix, single_bond_length):
+        dst_matrix = dst_matrix / single_bond_length * Config.SINGLE_BOND_LENGTH
         LIIMITING_DISTANCE = 2.12
         adjacency_matrix = np.zeros_like(dst_matrix)
         adjacency_matrix[dst_matrix < LIIMITING_DISTANCE] = 1
@@ -100,12 +134,12 @@ def estimate_single_bond(fig: 'Figure') -> None:
     :param Figure fig: analysed figure
     :return: approximate length of a single bond
     :rtype: int"""
-    ccs = fig.connected_components
+    table = fig.cc_table
     # Get a rough bond length (line length) value from the two largest structures by finding lines
-    ccs = sorted(ccs, key=lambda cc: cc.area, reverse=True)
-    estimation_ccs = ccs[:2]
+    largest = np.argsort(-table.areas, kind='stable')[:2]
+    estimation_ccs = [table.panel(idx) for idx in largest]
     approx_line_lengths = []
-    biggest_cc = ccs[0]
+    biggest_cc = estimation_ccs[0]
     length_scan_param = 0.05 * min(biggest_cc.width, biggest_cc.height)
     pixel_masks = []
     for cc in estimation_ccs:
@@ -131,7 +165,8 @@ def estimate_single_bond(fig: 'Figure') -> None:
     for idx, cc in enumerate(estimation_ccs):
         pixel_mask = pixel_masks[idx] * 255
         corners = vectoriser.vectorise_image(pixel_mask, fig.single_bond_length * 0.6)
-        dst_matrix = np.array([[euclidean_distance(p1, p2) for p1 in corners] for p2 in corners])        
+        points = np.asarray(corners, dtype=float).reshape(-1, 2)
+        dst_matrix = cdist(points, points)
         try:
             nearest_atom_dists =np.sort(dst_matrix)[:, 1]
             nearest_atom_dists_all.extend(nearest_atom_dists)
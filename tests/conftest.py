@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Modules of the package are imported both as top-level modules and through `reactiondataextractor`
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT_DIR, os.path.join(ROOT_DIR, 'reactiondataextractor')]
@@ -0,0 +1,100 @@
+"""Parity and throughput of the inference backends of the arrow detector"""
+import importlib.util
+import os
+import time
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('torchvision')
+pytest.importorskip('cv2')
+
+from torchvision.models import resnet18
+
+from configs import ExtractorConfig
+from reactiondataextractor.extractors.arrows import ArrowExtractor, StepwiseClassifier
+from reactiondataextractor.models.segments import Figure
+
+BACKENDS = ['dynamic_int8', 'torchscript', 'compile', 'onnx']
+# int8 linear layers of the classifier head shift the class probabilities slightly
+TOLERANCES = {'dynamic_int8': 5e-2, 'torchscript': 1e-5, 'compile': 1e-4, 'onnx': 1e-4}
+
+
+def draw_figure():
+    """Draws solid, equilibrium-like and curly arrow shapes as well as a few text-like blobs on a black background"""
+    img = np.zeros((300, 400), dtype=np.uint8)
+    img[40, 20:180] = 255
+    img[35:46, 170:180] = 255
+    img[100, 220:380] = 255
+    img[106, 220:380] = 255
+    img[94:100, 360:370] = 255
+    img[107:113, 230:240] = 255
+    rows, cols = np.mgrid[:300, :400]
+    arc = (np.abs(np.hypot(rows - 220, cols - 100) - 50) < 2) & (rows < 220)
+    img[arc] = 255
+    img[150:165, 250:262] = 255
+    img[200:260, 300:303] = 255
+    img[230:250, 330:360] = 255
+    return img
+
+
+@pytest.fixture(scope='module')
+def extractor():
+    torch.manual_seed(0)
+    detector = resnet18()
+    detector.fc = StepwiseClassifier(512)
+    detector.eval()
+    detector.to(ExtractorConfig.DEVICE)
+    img = draw_figure()
+    # The constructor loads trained weights, which are not needed to compare the backends
+    extractor = ArrowExtractor.__new__(ArrowExtractor)
+    extractor.fig = Figure(img=img, raw_img=img)
+    extractor.arrow_detector = detector
+    return extractor
+
+
+@pytest.fixture(scope='module')
+def patches(extractor):
+    crops = extractor.preprocess_model_inputs(extractor.fig.connected_components)
+    return np.repeat(crops, 3, axis=1)
+
+
+@pytest.fixture
+def onnx_path(tmp_path, monkeypatch):
+    path = str(tmp_path / 'arrow_detector.onnx')
+    monkeypatch.setattr(ExtractorConfig, 'ARROW_DETECTOR_ONNX_PATH', path)
+    return path
+
+
+def create_runner(extractor, backend):
+    if backend == 'onnx':
+        pytest.importorskip('onnxruntime')
+    return extractor._create_detector_runner(backend)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_backend_matches_eager(extractor, patches, onnx_path, backend):
+    with torch.no_grad():
+        expected = extractor._create_detector_runner('eager')(patches)
+        result = create_runner(extractor, backend)(patches)
+    assert result.shape == expected.shape
+    np.testing.assert_allclose(result, expected, atol=TOLERANCES[backend])
+    assert next(extractor.arrow_detector.parameters()).device.type == torch.device(ExtractorConfig.DEVICE).type
+
+
+@pytest.mark.skipif(not os.environ.get('RDE_BENCHMARK'), reason='set RDE_BENCHMARK=1 to run the benchmark')
+def test_backend_throughput(extractor, patches, onnx_path, capsys):
+    batch = np.resize(patches, (ExtractorConfig.ARROW_DETECTOR_MAX_BATCH_SIZE,) + patches.shape[1:])
+    for backend in ['eager'] + BACKENDS:
+        if backend == 'onnx' and importlib.util.find_spec('onnxruntime') is None:
+            continue
+        run = extractor._create_detector_runner(backend)
+        with torch.no_grad():
+            run(batch)
+            start = time.perf_counter()
+            for _ in range(10):
+                run(batch)
+            elapsed = time.perf_counter() - start
+        with capsys.disabled():
+            print(f'\n{backend}: {10 * len(batch) / elapsed:.1f} patches/s')
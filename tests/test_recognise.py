@@ -0,0 +1,59 @@
+"""Parity of the batched array preprocessing of DECIMER inputs with the reference PIL preprocessing"""
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+pytest.importorskip('DECIMER')
+
+from recognise import DecimerRecogniser
+
+
+def draw_structure(height, width):
+    """Draws a crude grey-background diagram made of lines and a filled ring, as a BGR image"""
+    img = np.full((height, width, 3), 245, dtype=np.uint8)
+    rows, cols = np.mgrid[:height, :width]
+    center_row, center_col, radius = height / 2, width / 2, min(height, width) / 4
+    ring = np.abs(np.hypot(rows - center_row, cols - center_col) - radius) < max(min(height, width) / 40, 1)
+    img[ring] = 20
+    img[height // 5, width // 10:width * 9 // 10] = 0
+    img[height // 10:height * 9 // 10, width // 6] = 30
+    return img
+
+
+CROPS = {
+    'square': draw_structure(300, 300),
+    'wide': draw_structure(120, 450),
+    'tall': draw_structure(430, 140),
+    'tiny': draw_structure(23, 17),
+    'large': draw_structure(700, 560),
+    'blank': np.full((80, 80, 3), 255, dtype=np.uint8),
+}
+
+
+@pytest.fixture(scope='module')
+def recogniser():
+    return DecimerRecogniser()
+
+
+@pytest.mark.parametrize('name', CROPS)
+def test_decode_images_matches_decode_image(recogniser, name):
+    img = CROPS[name]
+    expected = np.asarray(recogniser.decode_image(img))
+    result = np.asarray(recogniser.decode_images([img])[0])
+    assert result.shape == expected.shape
+    np.testing.assert_allclose(result, expected, atol=1e-4)
+
+
+def test_decode_images_batch_matches_single_images(recogniser):
+    imgs = list(CROPS.values())
+    batch = np.asarray(recogniser.decode_images(imgs))
+    for idx, img in enumerate(imgs):
+        np.testing.assert_allclose(batch[idx], np.asarray(recogniser.decode_images([img])[0]), atol=1e-6)
+
+
+def test_xla_backend_matches_saved_model(recogniser):
+    compiled = DecimerRecogniser(backend='xla')
+    structures = recogniser.decode_images([CROPS[name] for name in ['square', 'wide', 'tall', 'large']])
+    for structure in structures:
+        expected = recogniser.detokenize_output(recogniser.predict(structure))
+        assert compiled.detokenize_output(compiled.predict(structure)) == expected